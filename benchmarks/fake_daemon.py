@@ -0,0 +1,236 @@
+"""In-process stand-in for the ``plumtuna`` daemon's HTTP API.
+
+It implements the endpoints used by :class:`plumtuna.PlumtunaStorage` against a single
+in-memory message log per study, without any clustering.  Pass a :class:`FakeDaemon` as the
+``server`` of a storage to talk to it instead of spawning the real binary.
+"""
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class FakeStudy(object):
+    def __init__(self, study_id, study_name):
+        self.study_id = study_id
+        self.study_name = study_name
+        self.log = []
+        self.trials = {}
+        self.subscriptions = {}  # subscribe_id -> cursor in `log`
+
+
+class FakeDaemon(object):
+    """Replies in MessagePack to requests that accept it, unless ``binary`` is ``False``.
+
+    Each reply is delayed by ``latency`` seconds, to stand in for the round trip through a real
+    daemon and its cluster.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, binary=True, latency=0.0):
+        self.binary = binary and msgpack is not None
+        self.latency = latency
+        self.studies = {}
+        self.study_names = {}
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+        handler = type('Handler', (_Handler,), {'daemon': self})
+        self._httpd = ThreadingHTTPServer((host, port), handler)
+        self._httpd.daemon_threads = True
+        self.http_port = self._httpd.server_address[1]
+        self.rpc_addr = host
+        self.rpc_port = None
+        self.pid = os.getpid()
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def create_study(self, study_name):
+        with self._lock:
+            if study_name in self.study_names:
+                return None
+            study = FakeStudy('s{}'.format(self._new_id()), study_name)
+            self.studies[study.study_id] = study
+            self.study_names[study_name] = study.study_id
+            return study.study_id
+
+    def create_trial(self, study_id):
+        with self._lock:
+            study = self.studies[study_id]
+            trial_id = '{}.{}'.format(study_id, len(study.trials))
+            now = time.time()
+            study.trials[trial_id] = {
+                'trial_id': trial_id, 'state': 'RUNNING', 'value': None, 'params': {},
+                'intermediate_values': {}, 'user_attrs': {}, 'system_attrs': {},
+                'datetime_start': now, 'datetime_end': None,
+            }
+            study.log.append({'CreateTrial': {'trial_id': trial_id, 'timestamp': _timestamp(now)}})
+            return trial_id
+
+    def populate(self, study_id, n_trials, n_params=10, n_steps=10, distribution=None):
+        """Appends ``n_trials`` finished trials directly to the study log."""
+
+        distribution = distribution or json.dumps(
+            {'name': 'UniformDistribution', 'attributes': {'low': 0.0, 'high': 1.0}})
+        for i in range(n_trials):
+            trial_id = self.create_trial(study_id)
+            for j in range(n_params):
+                self.put_trial(trial_id, ['params', 'param_{}'.format(j)],
+                               {'value': (i * j % 97) / 97.0, 'distribution': distribution})
+            for step in range(n_steps):
+                self.put_trial(trial_id, ['intermediate_values', str(step)], (i % 89) / 89.0)
+            self.put_trial(trial_id, ['value'], (i % 89) / 89.0)
+            self.put_trial(trial_id, ['state'], 'COMPLETE')
+
+    def put_study(self, study_id, path, value):
+        with self._lock:
+            study = self.studies[study_id]
+            if path[0] == 'direction':
+                study.log.append({'SetStudyDirection': {'direction': value}})
+            elif path[0] == 'user_attrs':
+                study.log.append({'SetStudyUserAttr': {'key': path[1], 'value': value}})
+            elif path[0] == 'system_attrs':
+                study.log.append({'SetStudySystemAttr': {'key': path[1], 'value': value}})
+            else:
+                raise KeyError(path)
+
+    def put_trial(self, trial_id, path, value):
+        with self._lock:
+            study = self.studies[trial_id.split('.')[0]]
+            trial = study.trials[trial_id]
+            if path[0] == 'state':
+                now = time.time()
+                trial['state'] = value
+                if value != 'RUNNING':
+                    trial['datetime_end'] = now
+                m = {'SetTrialState': {'trial_id': trial_id, 'state': value, 'timestamp': _timestamp(now)}}
+            elif path[0] == 'params':
+                trial['params'][path[1]] = value
+                m = {'SetTrialParam': {'trial_id': trial_id, 'key': path[1], 'value': value}}
+            elif path[0] == 'value':
+                trial['value'] = value
+                m = {'SetTrialValue': {'trial_id': trial_id, 'value': value}}
+            elif path[0] == 'intermediate_values':
+                trial['intermediate_values'][path[1]] = value
+                m = {'SetTrialIntermediateValue': {'trial_id': trial_id, 'step': int(path[1]),
+                                                   'value': value}}
+            elif path[0] == 'user_attrs':
+                trial['user_attrs'][path[1]] = value
+                m = {'SetTrialUserAttr': {'trial_id': trial_id, 'key': path[1], 'value': value}}
+            elif path[0] == 'system_attrs':
+                trial['system_attrs'][path[1]] = value
+                m = {'SetTrialSystemAttr': {'trial_id': trial_id, 'key': path[1], 'value': value}}
+            else:
+                raise KeyError(path)
+            study.log.append(m)
+
+    def subscribe(self, study_id):
+        with self._lock:
+            subscribe_id = self._new_id()
+            self.studies[study_id].subscriptions[subscribe_id] = 0
+            return subscribe_id
+
+    def poll(self, study_id, subscribe_id):
+        with self._lock:
+            study = self.studies[study_id]
+            cursor = study.subscriptions[subscribe_id]
+            study.subscriptions[subscribe_id] = len(study.log)
+            return study.log[cursor:]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    daemon = None  # set by FakeDaemon
+
+    def log_message(self, format, *args):
+        pass
+
+    def _path(self):
+        return [urllib.parse.unquote_plus(p) for p in self.path.split('?')[0].split('/')[1:]]
+
+    def _body(self):
+        n = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(n).decode('utf-8')) if n else None
+
+    def _reply(self, status, body):
+        if self.daemon.latency:
+            time.sleep(self.daemon.latency)
+        if self.daemon.binary and 'application/msgpack' in self.headers.get('Accept', ''):
+            content_type = 'application/msgpack'
+            data = msgpack.packb(body, use_bin_type=True)
+        else:
+            content_type = 'application/json'
+            data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, method):
+        d = self.daemon
+        p = self._path()
+        try:
+            if method == 'POST' and p == ['studies']:
+                study_id = d.create_study(self._body()['study_name'])
+                if study_id is None:
+                    return self._reply(409, 'duplicated study')
+                return self._reply(200, {'study_id': study_id})
+            if method == 'GET' and p[0] == 'study_names':
+                return self._reply(200, {'study_id': d.study_names[p[1]]})
+            if p[0] == 'studies' and len(p) >= 3:
+                study_id = p[1]
+                if method == 'POST' and p[2] == 'subscribe':
+                    return self._reply(200, d.subscribe(study_id))
+                if method == 'GET' and p[2] == 'subscribe':
+                    return self._reply(200, d.poll(study_id, int(p[3])))
+                if method == 'POST' and p[2] == 'trials':
+                    return self._reply(200, d.create_trial(study_id))
+                if method == 'GET' and p[2] == 'trials':
+                    return self._reply(200, list(d.studies[study_id].trials.values()))
+                if method == 'GET' and p[2] == 'n_trials':
+                    return self._reply(200, len(d.studies[study_id].trials))
+                if method == 'PUT':
+                    d.put_study(study_id, p[2:], self._body())
+                    return self._reply(200, None)
+            if p[0] == 'trials' and len(p) >= 2:
+                trial_id = p[1]
+                if method == 'GET' and len(p) == 2:
+                    trial = d.studies[trial_id.split('.')[0]].trials[trial_id]
+                    return self._reply(200, trial)
+                if method == 'PUT':
+                    d.put_trial(trial_id, p[2:], self._body())
+                    return self._reply(200, None)
+        except KeyError as e:
+            return self._reply(404, 'not found: {}'.format(e))
+        self._reply(404, 'no such endpoint: {} {}'.format(method, self.path))
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+
+def _timestamp(t):
+    return {'secs': int(t), 'nanos': int((t - int(t)) * 1e9)}
@@ -0,0 +1,153 @@
+"""Micro-benchmarks of PlumtunaStorage hot paths against an in-process fake daemon.
+
+Example:
+    $ python benchmarks/storage_bench.py --sizes 0 1000 10000 --threads 1 4 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from optuna import distributions
+from optuna import structs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_daemon import FakeDaemon  # NOQA
+import plumtuna  # NOQA
+
+DISTRIBUTION = distributions.UniformDistribution(low=0.0, high=1.0)
+
+
+def report_trial(storage, trial_id, n_params=5, n_steps=10):
+    """Writes what a typical objective reports for a trial, and completes it."""
+
+    for j in range(n_params):
+        storage.set_trial_param(trial_id, 'x{}'.format(j), 0.5, DISTRIBUTION)
+    for step in range(n_steps):
+        storage.set_trial_intermediate_value(trial_id, step, 0.5)
+    storage.set_trial_user_attr(trial_id, 'host', 'bench')
+    storage.set_trial_value(trial_id, 0.5)
+    storage.set_trial_state(trial_id, structs.TrialState.COMPLETE)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def run(name, op, n_threads, n_ops):
+    """Calls ``op(thread_index, i)`` ``n_ops`` times on each of ``n_threads`` threads."""
+
+    latencies = [[] for _ in range(n_threads)]
+
+    def worker(t):
+        for i in range(n_ops):
+            start = time.perf_counter()
+            op(t, i)
+            latencies[t].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(n_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    values = sorted(v for vs in latencies for v in vs)
+    return {
+        'op': name,
+        'threads': n_threads,
+        'ops': len(values),
+        'ops_per_sec': len(values) / elapsed,
+        'p50_ms': percentile(values, 0.5) * 1e3,
+        'p99_ms': percentile(values, 0.99) * 1e3,
+    }
+
+
+def bench_size(daemon, study_size, n_threads, n_ops, storage_kwargs):
+    storage = plumtuna.PlumtunaStorage(server=daemon, **storage_kwargs)
+    study_name = 'bench-{}-{}-{}'.format(study_size, n_threads, time.time())
+    study_id = storage.create_new_study_id(study_name)
+    storage.set_study_direction(study_id, structs.StudyDirection.MINIMIZE)
+    daemon.populate(study_id, study_size)
+
+    # Replaying the backlog: a fresh storage subscribes and polls the whole history once.
+    cold = plumtuna.PlumtunaStorage(server=daemon, **storage_kwargs)
+    cold.get_study_id_from_name(study_name)
+    start = time.perf_counter()
+    cold._poll(study_id)
+    elapsed = time.perf_counter() - start
+    backlog = {
+        'op': '_poll_backlog',
+        'threads': 1,
+        'ops': 1,
+        'messages': cold.get_replica_seq(study_id),
+        'ops_per_sec': 1 / elapsed,
+        'p50_ms': elapsed * 1e3,
+        'p99_ms': elapsed * 1e3,
+    }
+    cold.close()
+
+    trial_ids = [[storage.create_new_trial_id(study_id) for _ in range(n_ops)]
+                 for _ in range(n_threads)]
+    report_ids = [[storage.create_new_trial_id(study_id) for _ in range(n_ops)]
+                  for _ in range(n_threads)]
+    results = [
+        run('create_new_trial_id', lambda t, i: storage.create_new_trial_id(study_id),
+            n_threads, n_ops),
+        run('set_trial_param', lambda t, i: storage.set_trial_param(
+            trial_ids[t][i], 'x', 0.5, DISTRIBUTION), n_threads, n_ops),
+        run('set_trial_intermediate_value', lambda t, i: storage.set_trial_intermediate_value(
+            trial_ids[t][i], 0, 0.5), n_threads, n_ops),
+        run('report_trial', lambda t, i: report_trial(storage, report_ids[t][i]),
+            n_threads, n_ops),
+        run('get_all_trials', lambda t, i: storage.get_all_trials(study_id), n_threads, n_ops),
+        run('_poll', lambda t, i: storage._poll(study_id), n_threads, n_ops),
+        backlog,
+    ]
+    storage.close()
+    for r in results:
+        r['study_size'] = study_size
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[0, 1000, 10000],
+                        help='number of finished trials in the study before measuring')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--ops', type=int, default=200, help='operations per thread')
+    parser.add_argument('--storage-kwargs', type=json.loads, default={},
+                        help='JSON object of extra PlumtunaStorage arguments')
+    parser.add_argument('--json', action='store_true',
+                        help='have the fake daemon reply in JSON rather than MessagePack')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='delay of each reply of the fake daemon')
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write results to')
+    args = parser.parse_args()
+
+    daemon = FakeDaemon(binary=not args.json, latency=args.latency_ms / 1e3)
+    results = []
+    try:
+        for size in args.sizes:
+            for n_threads in args.threads:
+                for r in bench_size(daemon, size, n_threads, args.ops, args.storage_kwargs):
+                    results.append(r)
+                    print('{op:>30} size={study_size:<7} threads={threads:<3} '
+                          '{ops_per_sec:10.1f} ops/s  p50={p50_ms:8.3f}ms  p99={p99_ms:8.3f}ms'
+                          .format(**r))
+    finally:
+        daemon.close()
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'storage_kwargs': args.storage_kwargs, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,24 @@
-from plumtuna.server import PlumtunaServer  # NOQA
-from plumtuna.storage import PlumtunaStorage  # NOQA
+import importlib
+
+# The public classes are imported on first access, so that `import plumtuna` doesn't pull in
+# optuna's storages and requests.
+_EXPORTS = {
+    'PlumtunaServer': 'plumtuna.server',
+    'SharedPlumtunaServer': 'plumtuna.server',
+    'PlumtunaStorage': 'plumtuna.storage',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
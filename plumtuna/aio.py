@@ -0,0 +1,449 @@
+"""asyncio client for plumtuna.
+
+:class:`AsyncPlumtunaStorage` exposes the storage API as coroutines that run on a single event
+loop and share one pooled ``aiohttp`` connector, so many trials and subscriptions can be served
+without a thread per call.  It keeps the same :class:`~plumtuna.storage.StudyState` replicas
+as :class:`~plumtuna.storage.PlumtunaStorage`.
+
+:class:`SyncPlumtunaStorage` adapts it back to ``optuna.storages.base.BaseStorage`` by running
+the loop in a background thread.
+"""
+
+import asyncio
+import copy
+import itertools
+import logging
+from optuna import distributions
+from optuna.storages import base
+from optuna.storages.base import DEFAULT_STUDY_NAME_PREFIX
+from optuna import structs
+import threading
+from typing import Any  # NOQA
+from typing import Dict  # NOQA
+from typing import List  # NOQA
+from typing import Optional  # NOQA
+import urllib.parse
+import uuid
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from plumtuna.server import DEFAULT_READY_TIMEOUT
+from plumtuna.server import PlumtunaServer
+from plumtuna.storage import StudyState
+from plumtuna.storage import trial_state_to_str
+from plumtuna.subscriber import DEFAULT_POLL_INTERVAL
+from plumtuna.transport import BINARY_ACCEPT
+from plumtuna.transport import DEFAULT_POOL_SIZE
+from plumtuna.transport import DEFAULT_TIMEOUT
+from plumtuna.transport import JSON
+from plumtuna.transport import MSGPACK
+from plumtuna.transport import decode_json
+from plumtuna.transport import encode_json
+from plumtuna.transport import msgpack
+
+
+_logger = logging.getLogger(__name__)
+
+
+class AsyncPlumtunaStorage(object):
+    def __init__(self, bind_addr=None, bind_port=None, contact_host=None, contact_port=None,
+                 pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 ready_timeout=DEFAULT_READY_TIMEOUT, server=None):
+        if aiohttp is None:
+            raise ImportError('AsyncPlumtunaStorage requires aiohttp')
+
+        self._owns_server = server is None
+        if server is None:
+            server = PlumtunaServer(bind_addr, bind_port, contact_host, contact_port, ready_timeout)
+        self.server = server
+        self.http_host = '127.0.0.1'
+        self.http_port = self.server.http_port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.studies = {}
+
+        self._session = None  # created on the running loop by `_http`
+        self._poll_locks = {}  # study_id -> asyncio.Lock
+        self._clock = itertools.count(1)  # see `PlumtunaStorage._sync`
+        self._subscriber = None
+        self._subscriber_error = None  # of the latest round of the subscriber task
+
+    async def _http(self, method, path, body=None):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+            accept = JSON if msgpack is None else BINARY_ACCEPT
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                                  headers={'Accept': accept})
+
+        url = 'http://{}:{}{}'.format(self.http_host, self.http_port, path)
+        data = None if body is None else encode_json(body)
+        async with self._session.request(method, url, data=data) as res:
+            content = await res.read()
+            try:
+                if res.content_type == MSGPACK and msgpack is not None:
+                    return res.status, msgpack.unpackb(content, raw=False, strict_map_key=False)
+                return res.status, decode_json(content)
+            except ValueError:
+                return res.status, content.decode('utf-8', 'replace')
+
+    async def _request(self, method, path, body=None):
+        status, res = await self._http(method, path, body)
+        assert status == 200, '{}: {}'.format(path, res)
+        return res
+
+    async def _write(self, study_id, path, body):
+        await self._request('PUT', path, body)
+        study = self.studies.get(study_id)
+        if study is not None:
+            study.dirty_after = next(self._clock)
+
+    async def _subscribe(self, study_id, study_name):
+        if study_id not in self._poll_locks:
+            self._poll_locks[study_id] = asyncio.Lock()
+        async with self._poll_locks[study_id]:
+            if study_id not in self.studies:
+                subscribe_id = await self._request('POST', '/studies/{}/subscribe'.format(study_id))
+                self.studies[study_id] = StudyState(study_id, study_name, subscribe_id)
+
+    async def _poll(self, study_id, after=None):
+        # Waiters queue on the study's lock; whoever gets it finds out whether the poll that
+        # just finished already started late enough, so concurrent readers share polls.
+        study = self.studies[study_id]
+        if after is None:
+            after = next(self._clock)
+        async with self._poll_locks[study_id]:
+            if study.synced >= after:
+                return
+            started = next(self._clock)
+            path = '/studies/{}/subscribe/{}'.format(study_id, study.subscribe_id)
+            study.apply(await self._request('GET', path))
+            study.synced = max(study.synced, started)
+
+    async def _sync(self, study_id):
+        study = self.studies[study_id]
+        if (self._subscriber is None or self._subscriber.done()
+                or self._subscriber_error is not None):
+            await self._poll(study_id)
+        else:
+            await self._poll(study_id, study.dirty_after)
+
+    def start_subscriber(self, interval=DEFAULT_POLL_INTERVAL):
+        """Starts a task on the running loop that keeps every subscribed study current.
+
+        As with :class:`~plumtuna.subscriber.Subscriber`, a poll that raises is logged and retried
+        on the next round, and reads poll by themselves until a round succeeds again.
+        """
+
+        async def run():
+            while True:
+                await asyncio.sleep(interval)
+                study_ids = list(self.studies)
+                results = await asyncio.gather(*[self._poll(study_id) for study_id in study_ids],
+                                               return_exceptions=True)
+                error = None
+                for study_id, result in zip(study_ids, results):
+                    if isinstance(result, Exception):
+                        error = result
+                        _logger.warning('plumtuna subscriber failed to poll study %s', study_id,
+                                        exc_info=result)
+                self._subscriber_error = error
+
+        self._subscriber = asyncio.ensure_future(run())
+
+    async def close(self):
+        if self._subscriber is not None:
+            self._subscriber.cancel()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._owns_server:
+            self.server.close()
+
+    def _study_id(self, trial_id):
+        return trial_id.split('.')[0]
+
+    async def create_new_study_id(self, study_name=None):
+        # type: (Optional[str]) -> int
+
+        if study_name is None:
+            study_uuid = str(uuid.uuid4())
+            study_name = DEFAULT_STUDY_NAME_PREFIX + study_uuid
+
+        status, res = await self._http('POST', '/studies', {'study_name': study_name})
+        if status == 409:
+            raise structs.DuplicatedStudyError
+
+        study_id = res['study_id']
+        await self._subscribe(study_id, study_name)
+        return study_id
+
+    async def set_study_user_attr(self, study_id, key, value):
+        # type: (int, str, Any) -> None
+
+        await self._write(study_id, '/studies/{}/user_attrs/{}'.format(
+            study_id, urllib.parse.quote_plus(key)), value)
+
+    async def set_study_direction(self, study_id, direction):
+        # type: (int, structs.StudyDirection) -> None
+
+        await self._write(study_id, '/studies/{}/direction'.format(study_id), direction.name)
+
+    async def set_study_system_attr(self, study_id, key, value):
+        # type: (int, str, Any) -> None
+
+        await self._write(study_id, '/studies/{}/system_attrs/{}'.format(
+            study_id, urllib.parse.quote_plus(key)), value)
+
+    async def get_study_id_from_name(self, study_name):
+        # type: (str) -> int
+
+        res = await self._request('GET', '/study_names/{}'.format(study_name))
+        study_id = res['study_id']
+        await self._subscribe(study_id, study_name)
+        return study_id
+
+    async def get_study_name_from_id(self, study_id):
+        # type: (int) -> str
+
+        return self.studies[study_id].study_name
+
+    async def get_study_direction(self, study_id):
+        # type: (int) -> structs.StudyDirection
+
+        await self._sync(study_id)
+        return self.studies[study_id].direction
+
+    async def get_study_user_attrs(self, study_id):
+        # type: (int) -> Dict[str, Any]
+
+        await self._sync(study_id)
+        return copy.deepcopy(self.studies[study_id].user_attrs)
+
+    async def get_study_system_attrs(self, study_id):
+        # type: (int) -> Dict[str, Any]
+
+        await self._sync(study_id)
+        return copy.deepcopy(self.studies[study_id].system_attrs)
+
+    async def get_all_study_summaries(self):
+        # type: () -> List[structs.StudySummary]
+
+        await asyncio.gather(*[self._sync(study_id) for study_id in list(self.studies)])
+        return [s.summary() for s in list(self.studies.values())]
+
+    async def create_new_trial_id(self, study_id):
+        # type: (int) -> int
+
+        trial_id = await self._request('POST', '/studies/{}/trials'.format(study_id))
+        self.studies[study_id].dirty_after = next(self._clock)
+        return trial_id
+
+    async def set_trial_state(self, trial_id, state):
+        # type: (int, structs.TrialState) -> None
+
+        await self._write(self._study_id(trial_id), '/trials/{}/state'.format(trial_id),
+                          trial_state_to_str(state))
+
+    async def set_trial_param(self, trial_id, param_name, param_value_internal, distribution):
+        # type: (int, str, float, distributions.BaseDistribution) -> bool
+
+        await self._write(self._study_id(trial_id), '/trials/{}/params/{}'.format(trial_id, param_name),
+                          {'value': param_value_internal,
+                           'distribution': distributions.distribution_to_json(distribution)})
+        return True
+
+    async def get_trial_param(self, trial_id, param_name):
+        # type: (int, str) -> float
+
+        trial = await self.get_trial(trial_id)
+        return trial.params_in_internal_repr[param_name]
+
+    async def set_trial_value(self, trial_id, value):
+        # type: (int, float) -> None
+
+        await self._write(self._study_id(trial_id), '/trials/{}/value'.format(trial_id), value)
+
+    async def set_trial_intermediate_value(self, trial_id, step, intermediate_value):
+        # type: (int, int, float) -> bool
+
+        await self._write(self._study_id(trial_id),
+                          '/trials/{}/intermediate_values/{}'.format(trial_id, step),
+                          intermediate_value)
+        return True
+
+    async def set_trial_user_attr(self, trial_id, key, value):
+        # type: (int, str, Any) -> None
+
+        await self._write(self._study_id(trial_id), '/trials/{}/user_attrs/{}'.format(
+            trial_id, urllib.parse.quote_plus(key)), value)
+
+    async def set_trial_system_attr(self, trial_id, key, value):
+        # type: (int, str, Any) -> None
+
+        await self._write(self._study_id(trial_id), '/trials/{}/system_attrs/{}'.format(
+            trial_id, urllib.parse.quote_plus(key)), value)
+
+    async def get_trial(self, trial_id):
+        # type: (int) -> structs.FrozenTrial
+
+        study_id = self._study_id(trial_id)
+        await self._sync(study_id)
+        return self.studies[study_id].trial(trial_id)
+
+    async def get_all_trials(self, study_id):
+        # type: (int) -> List[structs.FrozenTrial]
+
+        await self._sync(study_id)
+        return self.studies[study_id].all_trials()
+
+    async def get_n_trials(self, study_id, state=None):
+        # type: (int, Optional[structs.TrialState]) -> int
+
+        await self._sync(study_id)
+        return self.studies[study_id].n_trials(state)
+
+    async def get_best_trial(self, study_id):
+        # type: (int) -> structs.FrozenTrial
+
+        await self._sync(study_id)
+        best_trial = self.studies[study_id].best_trial()
+        if best_trial is None:
+            raise ValueError('No trials are completed yet.')
+        return best_trial
+
+
+class SyncPlumtunaStorage(base.BaseStorage):
+    """``BaseStorage`` adapter that runs an :class:`AsyncPlumtunaStorage` on a background loop.
+
+    Keyword arguments are passed to :class:`AsyncPlumtunaStorage`.
+    """
+
+    def __init__(self, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='plumtuna-aio',
+                                        daemon=True)
+        self._thread.start()
+        self.storage = AsyncPlumtunaStorage(**kwargs)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def close(self):
+        self._run(self.storage.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def create_new_study_id(self, study_name=None):
+        # type: (Optional[str]) -> int
+
+        return self._run(self.storage.create_new_study_id(study_name))
+
+    def set_study_user_attr(self, study_id, key, value):
+        # type: (int, str, Any) -> None
+
+        self._run(self.storage.set_study_user_attr(study_id, key, value))
+
+    def set_study_direction(self, study_id, direction):
+        # type: (int, structs.StudyDirection) -> None
+
+        self._run(self.storage.set_study_direction(study_id, direction))
+
+    def set_study_system_attr(self, study_id, key, value):
+        # type: (int, str, Any) -> None
+
+        self._run(self.storage.set_study_system_attr(study_id, key, value))
+
+    def get_study_id_from_name(self, study_name):
+        # type: (str) -> int
+
+        return self._run(self.storage.get_study_id_from_name(study_name))
+
+    def get_study_name_from_id(self, study_id):
+        # type: (int) -> str
+
+        return self._run(self.storage.get_study_name_from_id(study_id))
+
+    def get_study_direction(self, study_id):
+        # type: (int) -> structs.StudyDirection
+
+        return self._run(self.storage.get_study_direction(study_id))
+
+    def get_study_user_attrs(self, study_id):
+        # type: (int) -> Dict[str, Any]
+
+        return self._run(self.storage.get_study_user_attrs(study_id))
+
+    def get_study_system_attrs(self, study_id):
+        # type: (int) -> Dict[str, Any]
+
+        return self._run(self.storage.get_study_system_attrs(study_id))
+
+    def get_all_study_summaries(self):
+        # type: () -> List[structs.StudySummary]
+
+        return self._run(self.storage.get_all_study_summaries())
+
+    def create_new_trial_id(self, study_id):
+        # type: (int) -> int
+
+        return self._run(self.storage.create_new_trial_id(study_id))
+
+    def set_trial_state(self, trial_id, state):
+        # type: (int, structs.TrialState) -> None
+
+        self._run(self.storage.set_trial_state(trial_id, state))
+
+    def set_trial_param(self, trial_id, param_name, param_value_internal, distribution):
+        # type: (int, str, float, distributions.BaseDistribution) -> bool
+
+        return self._run(self.storage.set_trial_param(
+            trial_id, param_name, param_value_internal, distribution))
+
+    def get_trial_param(self, trial_id, param_name):
+        # type: (int, str) -> float
+
+        return self._run(self.storage.get_trial_param(trial_id, param_name))
+
+    def set_trial_value(self, trial_id, value):
+        # type: (int, float) -> None
+
+        self._run(self.storage.set_trial_value(trial_id, value))
+
+    def set_trial_intermediate_value(self, trial_id, step, intermediate_value):
+        # type: (int, int, float) -> bool
+
+        return self._run(self.storage.set_trial_intermediate_value(trial_id, step, intermediate_value))
+
+    def set_trial_user_attr(self, trial_id, key, value):
+        # type: (int, str, Any) -> None
+
+        self._run(self.storage.set_trial_user_attr(trial_id, key, value))
+
+    def set_trial_system_attr(self, trial_id, key, value):
+        # type: (int, str, Any) -> None
+
+        self._run(self.storage.set_trial_system_attr(trial_id, key, value))
+
+    def get_trial(self, trial_id):
+        # type: (int) -> structs.FrozenTrial
+
+        return self._run(self.storage.get_trial(trial_id))
+
+    def get_all_trials(self, study_id):
+        # type: (int) -> List[structs.FrozenTrial]
+
+        return self._run(self.storage.get_all_trials(study_id))
+
+    def get_n_trials(self, study_id, state=None):
+        # type: (int, Optional[structs.TrialState]) -> int
+
+        return self._run(self.storage.get_n_trials(study_id, state))
+
+    def get_best_trial(self, study_id):
+        # type: (int) -> structs.FrozenTrial
+
+        return self._run(self.storage.get_best_trial(study_id))
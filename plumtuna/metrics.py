@@ -0,0 +1,156 @@
+"""Optional instrumentation of :class:`~plumtuna.storage.PlumtunaStorage`.
+
+A storage created with ``metrics=True`` records, per daemon endpoint, call counts, latency
+histograms and bytes sent/received, as well as time spent waiting for locks, messages applied
+per poll and replica lag.  When metrics are disabled nothing is recorded and the only cost is
+an ``is None`` check per call.
+"""
+
+import bisect
+import threading
+
+# Upper bounds (in seconds) of the latency buckets.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the messages-per-poll buckets.
+MESSAGE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+# Path segments that are followed by an identifier, and the placeholder used for it.
+_ID_SEGMENTS = {
+    'studies': '{study_id}',
+    'trials': '{trial_id}',
+    'study_names': '{study_name}',
+    'subscribe': '{subscribe_id}',
+    'params': '{name}',
+    'intermediate_values': '{step}',
+    'user_attrs': '{key}',
+    'system_attrs': '{key}',
+}
+
+
+def endpoint(method, path):
+    """Returns e.g. ``PUT /trials/{trial_id}/params/{name}`` for a concrete request path."""
+
+    parts = []
+    placeholder = None
+    for p in path.split('?')[0].split('/')[1:]:
+        if placeholder is not None:
+            parts.append(placeholder)
+            placeholder = None
+        else:
+            parts.append(p)
+            placeholder = _ID_SEGMENTS.get(p)
+    return '{} /{}'.format(method, '/'.join(parts))
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': list(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class Metrics(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._requests = {}  # endpoint -> Histogram
+        self._bytes_sent = {}  # endpoint -> int
+        self._bytes_received = {}  # endpoint -> int
+        self._lock_waits = {}  # lock name -> Histogram
+        self._poll_messages = Histogram(MESSAGE_BUCKETS)
+        self._replica_lag = Histogram(buckets)
+
+    def observe_request(self, method, path, seconds, bytes_sent, bytes_received):
+        name = endpoint(method, path)
+        with self._lock:
+            histogram = self._requests.get(name)
+            if histogram is None:
+                histogram = self._requests[name] = Histogram(self.buckets)
+                self._bytes_sent[name] = 0
+                self._bytes_received[name] = 0
+            histogram.observe(seconds)
+            self._bytes_sent[name] += bytes_sent
+            self._bytes_received[name] += bytes_received
+
+    def observe_lock_wait(self, name, seconds):
+        with self._lock:
+            histogram = self._lock_waits.get(name)
+            if histogram is None:
+                histogram = self._lock_waits[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def observe_poll(self, n_messages):
+        with self._lock:
+            self._poll_messages.observe(n_messages)
+
+    def observe_replica_lag(self, seconds):
+        with self._lock:
+            self._replica_lag.observe(seconds)
+
+    def snapshot(self):
+        """Returns a JSON-serializable copy of every metric."""
+
+        with self._lock:
+            return {
+                'requests': dict((name, dict(h.to_dict(),
+                                             bytes_sent=self._bytes_sent[name],
+                                             bytes_received=self._bytes_received[name]))
+                                 for name, h in self._requests.items()),
+                'lock_waits': dict((name, h.to_dict()) for name, h in self._lock_waits.items()),
+                'poll_messages': self._poll_messages.to_dict(),
+                'replica_lag': self._replica_lag.to_dict(),
+            }
+
+    def prometheus(self, prefix='plumtuna'):
+        """Renders the metrics in the Prometheus text exposition format."""
+
+        s = self.snapshot()
+        lines = []
+
+        def histogram(name, help, h, labels=''):
+            if not any(l.startswith('# HELP {}_{} '.format(prefix, name)) for l in lines):
+                lines.append('# HELP {}_{} {}'.format(prefix, name, help))
+                lines.append('# TYPE {}_{} histogram'.format(prefix, name))
+            cumulative = 0
+            for le, n in h['buckets']:
+                cumulative += n
+                bucket_labels = 'le="{}"'.format(le) if not labels else '{},le="{}"'.format(labels, le)
+                lines.append('{}_{}_bucket{{{}}} {}'.format(prefix, name, bucket_labels, cumulative))
+            suffix = '{{{}}}'.format(labels) if labels else ''
+            lines.append('{}_{}_sum{} {}'.format(prefix, name, suffix, h['sum']))
+            lines.append('{}_{}_count{} {}'.format(prefix, name, suffix, h['count']))
+
+        for name, h in sorted(s['requests'].items()):
+            histogram('request_seconds', 'Latency of daemon requests.', h,
+                      'endpoint="{}"'.format(_escape(name)))
+        for direction in ('sent', 'received'):
+            lines.append('# TYPE {}_bytes_{}_total counter'.format(prefix, direction))
+            for name, h in sorted(s['requests'].items()):
+                lines.append('{}_bytes_{}_total{{endpoint="{}"}} {}'.format(
+                    prefix, direction, _escape(name), h['bytes_' + direction]))
+        for name, h in sorted(s['lock_waits'].items()):
+            histogram('lock_wait_seconds', 'Time spent waiting for locks.', h,
+                      'lock="{}"'.format(_escape(name)))
+        histogram('poll_messages', 'Messages applied per poll.', s['poll_messages'])
+        histogram('replica_lag_seconds', 'Age of the replica when a read was served.',
+                  s['replica_lag'])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
@@ -1,11 +1,22 @@
 from contextlib import closing
+import atexit
+import fcntl
+import json
+import os
+import signal
 import socket
+import stat
 import subprocess
+import tempfile
+import time
+import uuid
 
 DEFAULT_PORT=7364
+DEFAULT_READY_TIMEOUT=30.0
 
 class PlumtunaServer(object):
-    def __init__(self, bind_addr=None, bind_port=None, contact_host=None, contact_port=None):
+    def __init__(self, bind_addr=None, bind_port=None, contact_host=None, contact_port=None,
+                 ready_timeout=DEFAULT_READY_TIMEOUT, detached=False):
         http_port = find_free_port()
         if contact_host is None:
             rpc_addr, rpc_port = find_rpc_server_addr_and_port(bind_addr, bind_port)
@@ -15,26 +26,210 @@ class PlumtunaServer(object):
 
         args = ["plumtuna",
                 "--http-port", str(http_port),
-                "--rpc-addr", "{}:{}".format(rpc_addr, rpc_port),
-                "--exit-if-stdin-close"]
+                "--rpc-addr", "{}:{}".format(rpc_addr, rpc_port)]
         if contact_host is not None:
             args.extend(["--contact-server", "{}:{}".format(contact_host, contact_port)])
 
-        self._process = subprocess.Popen(args, stdin=subprocess.PIPE)
+        # A detached daemon outlives this process (see `SharedPlumtunaServer`), so it mustn't
+        # write to our stdout or stderr, which may be a pipe read by whoever started us;
+        # otherwise it exits together with us.
+        self.detached = detached
+        if detached:
+            self._process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                             start_new_session=True)
+        else:
+            args.append("--exit-if-stdin-close")
+            self._process = subprocess.Popen(args, stdin=subprocess.PIPE)
         assert self._process is not None
+        self.pid = self._process.pid
+        self._owner_pid = os.getpid()  # a forked child must not kill its parent's daemon
 
         self.http_port = http_port
         self.rpc_addr = rpc_addr
         self.rpc_port = rpc_port
 
+        try:
+            self.wait_until_ready(ready_timeout)
+        except Exception:
+            self._process.kill()
+            raise
+
+    def wait_until_ready(self, timeout=DEFAULT_READY_TIMEOUT):
+        """Polls the HTTP port with exponential backoff until the daemon accepts connections."""
+
+        deadline = time.time() + timeout
+        delay = 0.005
+        while True:
+            code = self._process.poll()
+            if code is not None:
+                raise RuntimeError('plumtuna exited before becoming ready (exit code {})'.format(code))
+            try:
+                with closing(socket.create_connection(('127.0.0.1', self.http_port), timeout=delay)):
+                    return
+            except OSError:
+                pass
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError('plumtuna did not open port {} within {} seconds'.format(
+                    self.http_port, timeout))
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.5)
+
+    def close(self):
+        if not self.detached and self._owner_pid == os.getpid():
+            self._process.kill()
+
     def __del__(self):
-        if self._process is not None:
+        if (self._process is not None and not self.detached
+                and self._owner_pid == os.getpid()):
             try:
                 self._process.kill()
             except AttributeError:
                 pass
 
 
+class SharedPlumtunaServer(object):
+    """Attaches to the plumtuna daemon shared by all processes of this host and user.
+
+    The first process to attach spawns a detached daemon and records its address in
+    ``<state_dir>/<name>.json``; later ones reuse it.  Every attached instance holds a reference
+    file in ``<state_dir>/<name>.refs/`` (references of dead processes are pruned), and the
+    daemon is terminated when the last reference is released by :meth:`close`, which also runs at
+    interpreter exit.  All bookkeeping happens under an exclusive ``flock`` on
+    ``<state_dir>/<name>.lock``.
+
+    There is one shared daemon per cluster contact address, so workers of different clusters
+    don't end up in the same one.  ``state_dir`` defaults to :func:`default_state_dir` and has to
+    be private to the user (see :func:`private_dir`).  The other arguments only apply when the
+    daemon is spawned.
+    """
+
+    def __init__(self, bind_addr=None, bind_port=None, contact_host=None, contact_port=None,
+                 ready_timeout=DEFAULT_READY_TIMEOUT, state_dir=None):
+        state_dir = private_dir(state_dir or default_state_dir())
+        if contact_host is None:
+            name = 'daemon'
+        else:
+            name = 'daemon-{}-{}'.format(contact_host, contact_port or DEFAULT_PORT)
+        self._info_path = os.path.join(state_dir, name + '.json')
+        self._lock_path = os.path.join(state_dir, name + '.lock')
+        self._refs_dir = os.path.join(state_dir, name + '.refs')
+        os.makedirs(self._refs_dir, exist_ok=True)
+        self._ref_path = os.path.join(self._refs_dir, '{}-{}'.format(os.getpid(), uuid.uuid4().hex))
+
+        with self._locked():
+            info = self._load_info()
+            if info is None:
+                server = PlumtunaServer(bind_addr, bind_port, contact_host, contact_port,
+                                        ready_timeout, detached=True)
+                info = {'pid': server.pid, 'http_port': server.http_port,
+                        'rpc_addr': server.rpc_addr, 'rpc_port': server.rpc_port}
+                with open(self._info_path, 'w') as f:
+                    json.dump(info, f)
+            open(self._ref_path, 'w').close()
+
+        self.pid = info['pid']
+        self.http_port = info['http_port']
+        self.rpc_addr = info['rpc_addr']
+        self.rpc_port = info['rpc_port']
+        self._closed = False
+        self._owner_pid = os.getpid()
+        atexit.register(self.close)
+
+    def close(self):
+        if self._closed or self._owner_pid != os.getpid():
+            return  # the reference belongs to the parent of this (forked) process
+        self._closed = True
+        with self._locked():
+            try:
+                os.unlink(self._ref_path)
+            except FileNotFoundError:
+                pass
+            if self._live_refs() == 0:
+                try:
+                    os.kill(self.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+                try:
+                    os.unlink(self._info_path)
+                except FileNotFoundError:
+                    pass
+
+    def _locked(self):
+        f = open(self._lock_path, 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f  # closing the file releases the lock
+
+    def _load_info(self):
+        try:
+            with open(self._info_path) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not _is_alive(info['pid']):
+            return None
+        try:
+            with closing(socket.create_connection(('127.0.0.1', info['http_port']), timeout=1.0)):
+                return info
+        except OSError:
+            return None
+
+    def _live_refs(self):
+        n = 0
+        for ref in os.listdir(self._refs_dir):
+            if _is_alive(int(ref.split('-')[0])):
+                n += 1
+            else:
+                os.unlink(os.path.join(self._refs_dir, ref))
+        return n
+
+
+def default_state_dir(root=None):
+    """Returns the directory for the state that the processes of this user share on this host.
+
+    It is in ``$XDG_RUNTIME_DIR`` if that is set, and in ``root`` (by default the temporary
+    directory) otherwise.
+    """
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        root = runtime_dir
+    return os.path.join(root or tempfile.gettempdir(), 'plumtuna-{}'.format(os.getuid()))
+
+
+def private_dir(path):
+    """Creates the directory ``path`` with mode 0o700 if needed, and returns it.
+
+    Raises ``PermissionError`` unless ``path`` is a directory (not a symlink) of the current user
+    that neither group nor others can write to.  In a shared location such as ``/tmp``, another
+    user could otherwise create it first and plant the files that point our processes to their
+    daemon or replicas.
+    """
+
+    try:
+        os.makedirs(path, mode=0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+            or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise PermissionError('{} is not a directory that only uid {} can write to'.format(
+            path, os.getuid()))
+    return path
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
 def find_rpc_client_addr_and_port(addr=None, port=None, contact_host=None, contact_port=None):
     if addr is None or port is None:
         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -0,0 +1,300 @@
+"""Study replicas shared by the worker processes of a host.
+
+For each study, one process (the leader) keeps the replica current from its own subscription
+and publishes it to files in memory (in ``$XDG_RUNTIME_DIR``, or else ``/dev/shm`` where
+available, in a directory that only the user can write to): a snapshot (see
+:mod:`plumtuna.snapshot`) of the whole study, followed by a log of partial snapshots holding
+only the trials that changed since the previous publication.  Once the log has outgrown the
+snapshot, the leader starts a new generation with a fresh snapshot and an empty log.  The other
+processes (followers) load the snapshot once per generation and then apply the log as it grows,
+instead of each of them decoding every message of the study.
+
+Leadership is an ``flock`` held on a per-study file, so when the leader exits the next process
+to sync the study takes over, resuming from the published replica.  Next to the replica, the
+leader maintains a small control block holding the ``seq`` of the published replica, the
+(``time.monotonic``) start time of its latest poll, the generation and the length of its log;
+it is updated under a seqlock.  A leader that died mid-update leaves the seqlock held; its
+successor then republishes the newest snapshot, which is always complete.  A follower that is
+behind its own latest write asks the leader to poll right away by sending a datagram to the
+leader's socket, rather than waiting for its next scheduled poll.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from plumtuna import snapshot
+from plumtuna import server
+from plumtuna.server import _is_alive
+
+# version (odd while an update is in progress) | seq | start time of the latest poll |
+# generation (0 until something is published) | length of the log of the generation
+_CONTROL = struct.Struct('<QQdQQ')
+_FRAME = struct.Struct('<Q')  # length of a log entry
+
+# The log is compacted into a new snapshot once it is larger than this and the snapshot.
+_MIN_COMPACTION_SIZE = 1 << 20  # bytes
+
+# How long the control block may stay mid-update before its leader is presumed dead.
+_MAX_UPDATE_WAIT = 1.0  # seconds
+
+_logger = logging.getLogger(__name__)
+
+
+def default_state_dir():
+    return server.default_state_dir('/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+
+def replica_dir(http_port, pid, state_dir=None):
+    """Returns the directory holding the replicas of the daemon ``pid`` listening on ``http_port``.
+
+    Directories left behind by daemons that are gone are removed.
+    """
+
+    state_dir = server.private_dir(state_dir or default_state_dir())
+    for name in os.listdir(state_dir):
+        if name.startswith('replica-') and not _is_alive(int(name.split('-')[-1])):
+            shutil.rmtree(os.path.join(state_dir, name), ignore_errors=True)
+    directory = os.path.join(state_dir, 'replica-{}-{}'.format(http_port, pid))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+class SharedReplica(object):
+    def __init__(self, directory, study_id):
+        self._prefix = os.path.join(directory, urllib.parse.quote_plus(str(study_id)))
+        self._directory = directory
+        self._leader_fd = os.open(self._prefix + '.leader', os.O_RDWR | os.O_CREAT, 0o600)
+        self._wake_path = self._prefix + '.wake'
+        self.is_leader = False
+
+        # Leader: what was published, and the socket on which followers request polls.
+        self.published_seq = None
+        self._log_fd = None
+        self._snapshot_size = 0
+        self._wake = None
+        self._server = None
+        self._closing = False
+
+        # Follower: how much of the published replica has been applied.
+        self._generation = 0
+        self._offset = 0
+        self._client = None
+
+        fd = os.open(self._prefix + '.control', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < _CONTROL.size:
+                os.ftruncate(fd, _CONTROL.size)  # zero-filled: nothing published yet
+            self._control = mmap.mmap(fd, _CONTROL.size)
+        finally:
+            os.close(fd)
+
+    def try_lead(self):
+        """Becomes the leader of the study if nobody else is.  Returns whether we are."""
+
+        if not self.is_leader:
+            try:
+                fcntl.flock(self._leader_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            self.is_leader = True
+            version = _CONTROL.unpack_from(self._control)[0]
+            if version % 2:
+                self._recover(version)
+        return True
+
+    def _recover(self, version):
+        # The previous leader died while updating the control block, which may be torn.  Its
+        # newest snapshot is complete (snapshots are renamed into place) and is republished
+        # without the log of its generation.
+        name = os.path.basename(self._prefix)
+        generation = 0
+        for filename in os.listdir(self._directory):
+            parts = filename.rsplit('.', 2)
+            if len(parts) == 3 and parts[0] == name and parts[2] == 'snapshot':
+                generation = max(generation, int(parts[1]))
+        _CONTROL.pack_into(self._control, 0, version + 1, 0, 0.0, generation, 0)
+
+    def serve(self, poll):
+        """Calls ``poll()`` from a background thread whenever a follower requests a poll."""
+
+        assert self.is_leader
+        self._wake = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            os.unlink(self._wake_path)  # left behind by a previous leader
+        except FileNotFoundError:
+            pass
+        self._wake.bind(self._wake_path)
+        self._server = threading.Thread(target=self._serve, args=(poll,),
+                                        name='plumtuna-leader', daemon=True)
+        self._server.start()
+
+    def request(self):
+        """Asks the leader to poll as soon as possible."""
+
+        if self._client is None:
+            self._client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._client.setblocking(False)
+        try:
+            self._client.sendto(b'\0', self._wake_path)
+        except OSError:
+            pass  # no leader listening (yet), or requests are already pending
+
+    def state(self):
+        """Returns the ``seq`` of the published replica and the start time of the latest poll."""
+
+        return self._state()[:2]
+
+    def _state(self):
+        deadline = None
+        while True:
+            control = _CONTROL.unpack_from(self._control)
+            if control[0] % 2 == 0 and _CONTROL.unpack_from(self._control)[0] == control[0]:
+                return control[1:]
+            if deadline is None:
+                deadline = time.monotonic() + _MAX_UPDATE_WAIT
+            elif time.monotonic() >= deadline:
+                raise TimeoutError('the control block of {} stayed mid-update; its leader may '
+                                   'have died while publishing'.format(self._prefix))
+            time.sleep(0)
+
+    def needs_snapshot(self):
+        """Returns whether the next publication has to be a whole snapshot."""
+
+        if self.published_seq is None:
+            return True
+        log_size = self._state()[3]
+        return log_size >= max(self._snapshot_size, _MIN_COMPACTION_SIZE)
+
+    def publish(self, seq, polled_at, data=None, whole=False):
+        """Records a completed poll and publishes ``data``, if given.
+
+        ``data`` is a snapshot of the whole study if ``whole``, and otherwise a snapshot of the
+        trials changed since the previous publication, which is appended to the log.
+        """
+
+        assert self.is_leader
+        _, _, generation, log_size = self._state()
+        if data is not None and whole:
+            generation += 1
+            self._write(self._path(generation, '.snapshot'), data)
+            fd = os.open(self._path(generation, '.log'),
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o600)
+            if self._log_fd is not None:
+                os.close(self._log_fd)
+            self._log_fd = fd
+            self._snapshot_size = len(data)
+            log_size = 0
+        elif data is not None:
+            frame = _FRAME.pack(len(data)) + data
+            os.write(self._log_fd, frame)
+            log_size += len(frame)
+        if data is not None:
+            self.published_seq = seq
+
+        version = _CONTROL.unpack_from(self._control)[0]
+        struct.pack_into('<Q', self._control, 0, version + 1)
+        _CONTROL.pack_into(self._control, 0, version + 1, seq, polled_at, generation, log_size)
+        struct.pack_into('<Q', self._control, 0, version + 2)
+
+        if data is not None and whole and generation > 1:
+            for suffix in ('.snapshot', '.log'):
+                try:
+                    os.unlink(self._path(generation - 1, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def update(self, study):
+        """Brings the replica ``study`` up to date with the published one.
+
+        Returns ``False`` if nothing (of that study) was published yet.
+        """
+
+        while True:
+            _, _, generation, log_size = self._state()
+            if generation == 0:
+                return False
+            try:
+                if generation != self._generation:
+                    with open(self._path(generation, '.snapshot'), 'rb') as f:
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    with data:
+                        loaded = snapshot.loads(data, study.subscribe_id, study)
+                    if loaded.study_name != study.study_name:
+                        return False
+                    study.load_state(loaded)
+                    self._generation, self._offset = generation, 0
+                if log_size > self._offset:
+                    with open(self._path(generation, '.log'), 'rb') as f:
+                        f.seek(self._offset)
+                        data = f.read(log_size - self._offset)
+                    self._apply(study, data)
+                    self._offset = log_size
+                return True
+            except FileNotFoundError:
+                continue  # replaced by a newer generation meanwhile
+
+    def close(self):
+        if self._leader_fd is None:
+            return
+        if self._server is not None:
+            self._closing = True
+            self._wake.sendto(b'\0', self._wake_path)
+            self._server.join()
+            self._wake.close()
+            try:
+                os.unlink(self._wake_path)
+            except FileNotFoundError:
+                pass
+        if self._client is not None:
+            self._client.close()
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+        self._control.close()
+        os.close(self._leader_fd)  # releases the leadership
+        self._leader_fd = None
+        self.is_leader = False
+
+    def _serve(self, poll):
+        while True:
+            self._wake.recv(1)
+            try:
+                while True:  # requests that are already pending are served by the same poll
+                    self._wake.recv(1, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                pass
+            if self._closing:
+                return
+            try:
+                poll()
+            except Exception:
+                _logger.warning('plumtuna leader failed to poll on request', exc_info=True)
+
+    def _apply(self, study, data):
+        offset = 0
+        while offset < len(data):
+            size, = _FRAME.unpack_from(data, offset)
+            offset += _FRAME.size
+            snapshot.apply(study, data[offset:offset + size])
+            offset += size
+
+    def _path(self, generation, suffix):
+        return '{}.{}{}'.format(self._prefix, generation, suffix)
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
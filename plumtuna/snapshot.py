@@ -0,0 +1,252 @@
+"""Binary columnar snapshots of a :class:`~plumtuna.storage.StudyState`.
+
+Layout::
+
+    MAGIC | header length (uint32, little endian) | header (JSON) | columns
+
+The header holds the study metadata, the trial ids, the parameter names and distributions,
+the per-trial attrs and the byte length of every column.  Columns are raw ``array`` buffers
+in the order of ``COLUMNS``.  Trial values and intermediate values come with a flag telling
+whether they are set, which keeps NaN apart from ``None``; other missing floats are stored as
+NaN and missing distribution indices as -1.  ``trial_seq`` holds the ``seq`` of the latest
+message that touched each trial, which lets :func:`loads` reuse the unchanged records of a
+previous replica.  ``digest`` in the
+header is a CRC-32 of (a sample of) the messages that the snapshot reflects, against which
+the replayed messages are checked (see :meth:`~plumtuna.storage.StudyState.apply`).
+
+A snapshot may also hold only some of the trials (e.g. those changed since a previous one), to
+be applied to a replica with :func:`apply`.
+"""
+
+import array
+from datetime import datetime
+import json
+import math
+import os
+import struct
+import sys
+import tempfile
+import urllib.parse
+
+from optuna import structs
+
+MAGIC = b'PLTS\x04'
+
+COLUMNS = (
+    ('state', 'b'),
+    ('value', 'd'),
+    ('value_set', 'b'),  # whether `value` is set
+    ('datetime_start', 'd'),
+    ('datetime_complete', 'd'),
+    ('trial_seq', 'q'),
+    ('param_values', 'd'),  # n_trials x n_params
+    ('param_distributions', 'i'),  # n_trials x n_params
+    ('iv_trials', 'i'),
+    ('iv_steps', 'q'),
+    ('iv_values', 'd'),
+    ('iv_set', 'b'),  # whether `iv_values` is set (rather than None)
+)
+
+_TRIAL_STATES = list(structs.TrialState)
+_NAN = float('nan')
+
+
+def dumps(study, records=None):
+    """Serializes the study, or only the given trial ``records`` of it.
+
+    The caller must hold ``study.lock``.
+    """
+
+    if records is None:
+        records = study.records()
+    param_names = sorted(set(k for r in records for k in r.params_in_internal_repr))
+    param_positions = dict((k, i) for i, k in enumerate(param_names))
+    dist_positions = {}
+    n_params = len(param_names)
+
+    columns = dict((name, array.array(typecode)) for name, typecode in COLUMNS)
+    columns['param_values'] = array.array('d', [_NAN]) * (len(records) * n_params)
+    columns['param_distributions'] = array.array('i', [-1]) * (len(records) * n_params)
+    for i, r in enumerate(records):
+        columns['state'].append(_TRIAL_STATES.index(r.state))
+        columns['value'].append(_NAN if r.value is None else r.value)
+        columns['value_set'].append(r.value is not None)
+        columns['datetime_start'].append(_timestamp(r.datetime_start))
+        columns['datetime_complete'].append(_timestamp(r.datetime_complete))
+        columns['trial_seq'].append(r.seq)
+        for k, v in r.params_in_internal_repr.items():
+            j = i * n_params + param_positions[k]
+            columns['param_values'][j] = v
+            columns['param_distributions'][j] = dist_positions.setdefault(
+                r.param_distributions[k], len(dist_positions))
+        for step, v in r.intermediate_values.items():
+            columns['iv_trials'].append(i)
+            columns['iv_steps'].append(step)
+            columns['iv_values'].append(_NAN if v is None else v)
+            columns['iv_set'].append(v is not None)
+
+    buffers = [_to_bytes(columns[name]) for name, _ in COLUMNS]
+    header = {
+        'study_id': study.study_id,
+        'study_name': study.study_name,
+        'seq': study.seq,
+        'digest': study.digest,
+        'direction': study.direction.name,
+        'user_attrs': study.user_attrs,
+        'system_attrs': study.system_attrs,
+        'trial_ids': [r.trial_id for r in records],
+        'trial_user_attrs': [r.user_attrs for r in records],
+        'trial_system_attrs': [r.system_attrs for r in records],
+        'params': param_names,
+        'distributions': sorted(dist_positions, key=dist_positions.get),
+        'column_sizes': [len(b) for b in buffers],
+    }
+    header = json.dumps(header).encode('utf-8')
+    return b''.join([MAGIC, struct.pack('<I', len(header)), header] + buffers)
+
+
+def loads(data, subscribe_id=None, base=None):
+    """Deserializes a study.
+
+    Trials whose ``seq`` is the same as in the replica ``base`` share its records (and their
+    cached ``FrozenTrial``) instead of being decoded again.  ``base`` must no longer be updated.
+    """
+
+    from plumtuna.storage import StudyState  # NOQA
+
+    header, records = _decode(data, base)
+    study = StudyState(header['study_id'], header['study_name'], subscribe_id)
+    _load_study_attrs(study, header)
+    study.load_records(records, header['seq'])
+    return study
+
+
+def apply(study, data):
+    """Updates the replica ``study`` in place with the trials of a (partial) snapshot."""
+
+    header, records = _decode(data, study)
+    with study.lock:
+        _load_study_attrs(study, header)
+        study.update_records(records, header['seq'])
+
+
+def _load_study_attrs(study, header):
+    study.direction = structs.StudyDirection[header['direction']]
+    study.user_attrs = header['user_attrs']
+    study.system_attrs = header['system_attrs']
+    study.digest = header['digest']
+
+
+def _decode(data, base):
+    from plumtuna.storage import json_to_distribution  # NOQA
+    from plumtuna.storage import _TrialRecord  # NOQA
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a plumtuna snapshot')
+    offset = len(MAGIC)
+    header_size, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    header = json.loads(bytes(data[offset:offset + header_size]).decode('utf-8'))
+    offset += header_size
+
+    columns = {}
+    for (name, typecode), size in zip(COLUMNS, header['column_sizes']):
+        columns[name] = _from_bytes(typecode, data[offset:offset + size])
+        offset += size
+
+    param_names = header['params']
+    n_params = len(param_names)
+    dists = [(d, json_to_distribution(d)) for d in header['distributions']]
+    reused = base.trials if base is not None else {}
+    records = []
+    decoded = []
+    for i, trial_id in enumerate(header['trial_ids']):
+        r = reused.get(trial_id)
+        if r is not None and r.seq == columns['trial_seq'][i]:
+            records.append(r)
+            decoded.append(False)
+            continue
+        r = _TrialRecord(trial_id)
+        r.seq = columns['trial_seq'][i]
+        r.state = _TRIAL_STATES[columns['state'][i]]
+        r.value = columns['value'][i] if columns['value_set'][i] else None
+        r.datetime_start = _datetime(columns['datetime_start'][i])
+        r.datetime_complete = _datetime(columns['datetime_complete'][i])
+        r.user_attrs = header['trial_user_attrs'][i]
+        r.system_attrs = header['trial_system_attrs'][i]
+        for j, k in enumerate(param_names):
+            d = columns['param_distributions'][i * n_params + j]
+            if d < 0:
+                continue
+            v = columns['param_values'][i * n_params + j]
+            r.params_in_internal_repr[k] = v
+            r.params[k] = dists[d][1].to_external_repr(v)
+            r.param_distributions[k] = dists[d][0]
+        records.append(r)
+        decoded.append(True)
+    for i, step, v, is_set in zip(columns['iv_trials'], columns['iv_steps'],
+                                  columns['iv_values'], columns['iv_set']):
+        if decoded[i]:
+            records[i].intermediate_values[step] = v if is_set else None
+    return header, records
+
+
+def path(directory, study_id):
+    return os.path.join(directory, '{}.snapshot'.format(urllib.parse.quote_plus(str(study_id))))
+
+
+def save(directory, study_id, data):
+    """Atomically replaces the snapshot of ``study_id`` in ``directory``."""
+
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path(directory, study_id))
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def remove(directory, study_id):
+    try:
+        os.unlink(path(directory, study_id))
+    except FileNotFoundError:
+        pass
+
+
+def load(directory, study_id, study_name, subscribe_id=None):
+    """Returns the saved replica of the study, or ``None`` if there is no usable snapshot."""
+
+    try:
+        with open(path(directory, study_id), 'rb') as f:
+            study = loads(f.read(), subscribe_id)
+    except (OSError, ValueError, KeyError):
+        return None
+    if study.study_name != study_name:
+        return None
+    return study
+
+
+def _to_bytes(a):
+    if sys.byteorder != 'little':
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def _from_bytes(typecode, b):
+    a = array.array(typecode)
+    a.frombytes(b)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+
+def _timestamp(d):
+    return _NAN if d is None else d.timestamp()
+
+
+def _datetime(t):
+    return None if math.isnan(t) else datetime.fromtimestamp(t)
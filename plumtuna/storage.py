@@ -1,82 +1,500 @@
+import array
+import bisect
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import functools
+import heapq
 from datetime import datetime
-import json
 from optuna import distributions  # NOQA
 from optuna.storages import base
 from optuna.storages.base import DEFAULT_STUDY_NAME_PREFIX
 from optuna import structs
-import requests
-import time
+import itertools
+import math
+import os
 import threading
+import time
 from typing import Any  # NOQA
 from typing import Dict  # NOQA
 from typing import List  # NOQA
 from typing import Optional  # NOQA
 import urllib.parse
-import urllib.request
 import uuid
-
-from plumtuna import PlumtunaServer
+import zlib
+
+from plumtuna import shared
+from plumtuna import snapshot
+from plumtuna.metrics import Metrics
+from plumtuna.server import DEFAULT_READY_TIMEOUT
+from plumtuna.server import PlumtunaServer
+from plumtuna.server import SharedPlumtunaServer
+from plumtuna.subscriber import DEFAULT_POLL_INTERVAL
+from plumtuna.subscriber import Subscriber
+from plumtuna.table import TrialTable
+from plumtuna.transport import DEFAULT_POOL_SIZE
+from plumtuna.transport import DEFAULT_TIMEOUT
+from plumtuna.transport import decode_json
+from plumtuna.transport import encode_json
+from plumtuna.transport import HttpTransport
+from plumtuna.writer import AsyncWriter
+from plumtuna.writer import DEFAULT_BATCH_DELAY
+from plumtuna.writer import WriteBuffer
+
+DEFAULT_SNAPSHOT_INTERVAL = 10000  # messages
+DEFAULT_LEADER_TIMEOUT = 10.0  # seconds
+DEFAULT_BULK_BATCH_SIZE = 1000  # trials
 
 class PlumtunaStorage(base.BaseStorage):
-    def __init__(self, bind_addr=None, bind_port=None, contact_host=None, contact_port=None):
-        self.server = PlumtunaServer(bind_addr, bind_port, contact_host, contact_port)
-
-        # TODO
-        time.sleep(1)
-
-        self.http_host = '127.0.0.1'
-        self.http_port = self.server.http_port
+    def __init__(self, bind_addr=None, bind_port=None, contact_host=None, contact_port=None,
+                 pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, transport=None,
+                 write_batch_size=None, write_batch_delay=DEFAULT_BATCH_DELAY, async_writes=False,
+                 ready_timeout=DEFAULT_READY_TIMEOUT, poll_interval=None, snapshot_dir=None,
+                 snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL, server=None, metrics=False,
+                 shared_daemon=False, shared_replica=False,
+                 leader_timeout=DEFAULT_LEADER_TIMEOUT, max_trial_details=None, lazy=False):
+        if max_trial_details is not None and (snapshot_dir is not None or shared_replica):
+            raise ValueError('max_trial_details cannot be combined with snapshots or shared '
+                             'replicas')
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics or None
         self.studies = {}
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_interval = snapshot_interval
+        self.leader_timeout = leader_timeout
+
+        # Number of finished trials per study whose intermediate values and attrs are kept in
+        # the replica; the least recently used ones beyond that are re-fetched when read.  This
+        # mode is NOT meant for studies that samplers read: `get_all_trials`, which samplers
+        # call for every trial, doesn't put the fetched detail back, so each call re-fetches
+        # every evicted trial (and all trials of the study once more than a few are evicted).
+        # It is for studies read through the step index and `get_trial`, e.g. by pruners and
+        # dashboards.  It bounds the per-trial dicts only; the step index still grows.
+        self.max_trial_details = max_trial_details
+
+        # Guards `studies`.  Each study has its own locks (see `StudyState`), so no network I/O
+        # on an existing study happens under this one.
         self._lock = threading.Lock()
 
+        # Logical clock ordering completed writes against poll starts (see `_sync`).
+        self._clock = itertools.count(1)
+        self._clock_lock = threading.Lock()
+
+        # The daemon, the transport and the background threads are set up by `_connect`: right
+        # away, or with `lazy` on the first call that needs them.
+        self._options = {
+            'bind_addr': bind_addr, 'bind_port': bind_port, 'contact_host': contact_host,
+            'contact_port': contact_port, 'ready_timeout': ready_timeout,
+            'shared_daemon': shared_daemon, 'pool_size': pool_size, 'timeout': timeout,
+            'transport': transport, 'write_batch_size': write_batch_size,
+            'write_batch_delay': write_batch_delay, 'async_writes': async_writes,
+            'poll_interval': poll_interval, 'shared_replica': shared_replica,
+        }
+        self._owns_server = server is None
+        self.server = server
+        self._pid = None  # of the process that connected
+        self._connect_lock = threading.Lock()
+        if not lazy:
+            self._connect()
+
+    def _connect(self):
+        # Connects on the first call, and again in a forked child: it can't share the daemon
+        # process, connections, threads or locks of its parent, so it gets its own and
+        # re-subscribes to the studies it inherited.
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        forked = self._pid is not None
+        if forked:
+            self._connect_lock = threading.Lock()
+            self._lock = threading.Lock()
+            self._clock_lock = threading.Lock()
+        with self._connect_lock:
+            if self._pid == pid:
+                return
+            o = self._options
+            if self._owns_server and o['shared_daemon']:
+                self.server = SharedPlumtunaServer(o['bind_addr'], o['bind_port'],
+                                                   o['contact_host'], o['contact_port'],
+                                                   o['ready_timeout'])
+            elif self._owns_server:
+                bind_port, contact_host, contact_port = (o['bind_port'], o['contact_host'],
+                                                         o['contact_port'])
+                if forked:
+                    # The parent's daemon holds the explicit `bind_port`.
+                    bind_port = None
+                    if contact_host is None:
+                        # Join the cluster of the parent's daemon rather than starting a new one.
+                        contact_host, contact_port = self.server.rpc_addr, self.server.rpc_port
+                self.server = PlumtunaServer(o['bind_addr'], bind_port, contact_host,
+                                             contact_port, o['ready_timeout'])
+
+            self.http_host = '127.0.0.1'
+            self.http_port = self.server.http_port
+            self._transport = o['transport']
+            if self._transport is None:
+                self._transport = HttpTransport(self.http_host, self.http_port, o['pool_size'],
+                                                o['timeout'], metrics=self.metrics)
+            self._async_writer = AsyncWriter(self._write_trial) if o['async_writes'] else None
+            # With `write_batch_size`, trial writes are buffered and flushed concurrently (see
+            # `WriteBuffer`).  The daemon has no batch endpoint: each write is still a request.
+            if o['write_batch_size'] is None:
+                self._write_buffer = None
+            else:
+                self._write_buffer = WriteBuffer(self._send_write, o['write_batch_size'],
+                                                 o['write_batch_delay'], o['pool_size'])
+
+            # With `shared_replica`, the replica of each study is maintained by one process of
+            # the host and mapped by the others (see `plumtuna.shared`).  The leader has to keep
+            # polling on their behalf.
+            poll_interval = o['poll_interval']
+            if o['shared_replica']:
+                self._replica_dir = shared.replica_dir(self.http_port, self.server.pid)
+                self._replicas = {}  # study_id -> SharedReplica
+                if poll_interval is None:
+                    poll_interval = DEFAULT_POLL_INTERVAL
+            else:
+                self._replicas = None
+
+            self._pid = pid
+            if forked:
+                studies, self.studies = self.studies, {}
+                for study in studies.values():
+                    self._subscribe(study.study_id, study.study_name)
+
+            if poll_interval is None:
+                self._subscriber = None
+            else:
+                self._subscriber = Subscriber(self._poll, self._subscribed_study_ids,
+                                              poll_interval)
+
     @property
     def rpc_addr(self):
+        self._connect()
         return self.server.rpc_addr
 
     @property
     def rpc_port(self):
+        self._connect()
         return self.server.rpc_port
 
     def _get(self, path):
-        res = requests.get('http://{}:{}{}'.format(self.http_host, self.http_port, path))
-        assert res.status_code is 200, '{}: {}'.format(path, res.text)
-        return res.json()
+        self._check_async_writes()
+        return self._request('GET', path)
 
     def _post(self, path, body=None):
-        if body is None:
-            res = requests.post('http://{}:{}{}'.format(self.http_host, self.http_port, path))
-        else:
-            res = requests.post('http://{}:{}{}'.format(self.http_host, self.http_port, path),
-                                data=json.dumps(body))
-        assert res.status_code is 200, '{}: {}'.format(path, res.text)
-        return res.json()
+        self._check_async_writes()
+        return self._request('POST', path, body)
+
+    def _request(self, method, path, body=None):
+        # Unlike `_get` and `_post`, doesn't raise the errors of asynchronous writes: those
+        # belong to the caller that made them, not e.g. to the background subscriber.
+        self._connect()
+        status, res = self._transport.request(method, path, body)
+        assert status == 200, '{}: {}'.format(path, res)
+        return res
 
     def _post2(self, path, body=None):
-        if body is None:
-            res = requests.post('http://{}:{}{}'.format(self.http_host, self.http_port, path))
-        else:
-            res = requests.post('http://{}:{}{}'.format(self.http_host, self.http_port, path),
-                                data=json.dumps(body))
-        return res.status_code, res.json()
+        self._connect()
+        return self._transport.request('POST', path, body)
 
     def _put(self, path, body):
-        res = requests.put('http://{}:{}{}'.format(self.http_host, self.http_port, path), data=json.dumps(body))
-        assert res.status_code is 200, '{}: {}'.format(path, res.text)
-        return res.json()
+        self._connect()
+        status, res = self._transport.request('PUT', path, body)
+        assert status == 200, '{}: {}'.format(path, res)
+        return res
+
+    def _put_trial(self, trial_id, path, body):
+        self._connect()
+        if self._write_buffer is None:
+            self._send_write(trial_id, path, body)
+        else:
+            self._write_buffer.put(self._study_id(trial_id), trial_id, path, body)
+
+    def _send_write(self, trial_id, path, body):
+        if self._async_writer is None:
+            self._write_trial(trial_id, path, body)
+        else:
+            self._async_writer.put(trial_id, path, body)
+
+    def _write_trial(self, trial_id, path, body):
+        self._put(path, body)
+        self._mark_dirty(self._study_id(trial_id))
+
+    def _write_study(self, study_id, path, body):
+        self._put(path, body)
+        self._mark_dirty(study_id)
+
+    def _mark_dirty(self, study_id):
+        # Called once a write has been acknowledged: a replica is only fresh again after a poll
+        # that started later than this.
+        study = self.studies.get(study_id)
+        if study is not None:
+            study.dirty_after = max(study.dirty_after, self._tick())
+            study.dirty_at = time.monotonic()
+
+    def _flush_writes(self, study_id=None, trial_id=None):
+        self._connect()
+        if self._write_buffer is not None:
+            self._write_buffer.flush(study_id, trial_id)
+        if self._async_writer is not None:
+            self._async_writer.wait(trial_id)
+
+    def _check_async_writes(self):
+        self._connect()
+        if self._async_writer is not None:
+            self._async_writer.check()
+
+    def close(self):
+        if self._pid != os.getpid():
+            return  # never connected, or connected by the parent of this (forked) process
+        if self._subscriber is not None:
+            self._subscriber.close()
+        if self.snapshot_dir is not None:
+            for study in list(self.studies.values()):
+                self._save_snapshot(study)
+        self._flush_writes()
+        if self._write_buffer is not None:
+            self._write_buffer.close()
+        if self._async_writer is not None:
+            self._async_writer.close()
+        if self._replicas is not None:
+            for replica in list(self._replicas.values()):
+                replica.close()
+        self._transport.close()
+        if self._owns_server:
+            self.server.close()
+
+    def get_metrics(self):
+        """Returns a snapshot of the recorded metrics, or ``None`` if they are disabled."""
+
+        if self.metrics is None:
+            return None
+        return self.metrics.snapshot()
+
+    def _acquire(self, lock, name):
+        if self.metrics is None:
+            lock.acquire()
+        else:
+            start = time.perf_counter()
+            lock.acquire()
+            self.metrics.observe_lock_wait(name, time.perf_counter() - start)
 
     def _subscribe(self, study_id, study_name):
-        with self._lock:
+        self._connect()
+        self._acquire(self._lock, 'storage')
+        try:
             if study_id not in self.studies:
-                subscribe_id = self._post('/studies/{}/subscribe'.format(study_id))
-                self.studies[study_id] = StudyState(study_id, study_name, subscribe_id)
+                replica = None
+                if self._replicas is not None:
+                    replica = self._replicas[study_id] = shared.SharedReplica(self._replica_dir,
+                                                                              study_id)
+                    if not replica.try_lead():
+                        # Follow the leader: the replica is loaded on the first sync.
+                        study = self._new_study_state(study_id, study_name, None)
+                        study.dirty_at = time.monotonic()
+                        self.studies[study_id] = study
+                        return
 
-    def _poll(self, study_id):
-        with self._lock:
-            subscribe_id = self.studies[study_id].subscribe_id
-            messages = self._get('/studies/{}/subscribe/{}'.format(study_id, subscribe_id))
-            for m in messages:
-                self.studies[study_id].handle_message(m)
+                subscribe_id = self._post('/studies/{}/subscribe'.format(study_id))
+                study = None
+                if replica is not None:
+                    study = self._new_study_state(study_id, study_name, subscribe_id)
+                    if not replica.update(study):  # resume from a previous leader, if any
+                        study = None
+                if study is None and self.snapshot_dir is not None:
+                    study = snapshot.load(self.snapshot_dir, study_id, study_name, subscribe_id)
+                if study is None:
+                    study = self._new_study_state(study_id, study_name, subscribe_id)
+                self.studies[study_id] = study
+                if replica is not None:
+                    self._lead(study, replica)
+        finally:
+            self._lock.release()
+
+    def _new_study_state(self, study_id, study_name, subscribe_id):
+        study = StudyState(study_id, study_name, subscribe_id, self.max_trial_details)
+        if self.snapshot_dir is not None or self._replicas is not None:
+            study.digest = 0  # to check replayed messages against, once loaded from a snapshot
+        return study
+
+    def _replay(self, study):
+        # The subscription replayed other messages than those the loaded replica reflects (e.g.
+        # the study was created again after the daemon lost it): replay it all from scratch.
+        if self.snapshot_dir is not None:
+            snapshot.remove(self.snapshot_dir, study.study_id)
+        with study.lock:
+            study.load_state(self._new_study_state(study.study_id, study.study_name, None))
+            study.snapshot_seq = 0
+            if self._replicas is not None:
+                self._replicas[study.study_id].published_seq = None
+                study.track_changes()
+        study.subscribe_id = self._request('POST', '/studies/{}/subscribe'.format(study.study_id))
+        messages = self._request('GET', '/studies/{}/subscribe/{}'.format(study.study_id,
+                                                                         study.subscribe_id))
+        study.apply(messages)
+        return messages
+
+    def _subscribed_study_ids(self):
+        return [k for k, s in list(self.studies.items()) if s.subscribe_id is not None]
+
+    def _follow(self, study):
+        # Catches up with the replica published by the leader once it reflects our latest
+        # write, or takes over the subscription if the leader has gone.
+        replica = self._replicas[study.study_id]
+        deadline = time.monotonic() + self.leader_timeout
+        delay = 0.0005
+        requested = False
+        while True:
+            if replica.try_lead():
+                replica.update(study)
+                study.subscribe_id = self._request('POST',
+                                                   '/studies/{}/subscribe'.format(study.study_id))
+                self._lead(study, replica)
+                return
+            seq, polled_at = replica.state()
+            if polled_at >= study.dirty_at:
+                break
+            if not requested:  # behind: ask the leader to poll rather than wait for its round
+                replica.request()
+                requested = True
+            if time.monotonic() >= deadline:
+                raise TimeoutError('the leader of study {} did not poll within {} seconds'.format(
+                    study.study_id, self.leader_timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+        if seq != study.seq:
+            replica.update(study)
+
+    def _lead(self, study, replica):
+        # Called once we lead the shared replica and are subscribed: the replayed messages
+        # that the replica already reflects are skipped, and followers may request polls.
+        study.skip_replayed()
+        study.track_changes()
+        replica.serve(functools.partial(self._poll, study.study_id))
+
+    def _publish(self, study, polled_at):
+        # Publishes the trials changed since the previous publication, or a new snapshot of the
+        # whole study once the log of changes has grown too large.
+        replica = self._replicas[study.study_id]
+        with study.lock:
+            seq = study.seq
+            whole = replica.needs_snapshot()
+            if seq == replica.published_seq:
+                data = None
+            elif whole:
+                study.take_changes()
+                data = snapshot.dumps(study)
+            else:
+                data = snapshot.dumps(study, study.take_changes())
+        replica.publish(seq, polled_at, data, whole)
+
+    def _save_snapshot(self, study):
+        with study.lock:
+            if study.seq == study.snapshot_seq or study.skip:
+                return
+            data = snapshot.dumps(study)
+            study.snapshot_seq = study.seq
+        snapshot.save(self.snapshot_dir, study.study_id, data)
+
+    def _tick(self):
+        with self._clock_lock:
+            return next(self._clock)
+
+    def _poll(self, study_id, after=None):
+        # Ensures that a poll which started later than clock value `after` (default: now) has
+        # completed.  Polls are single-flight per study: while one is in flight, other callers
+        # wait for it, and those it can't satisfy share the next one.
+        self._connect()
+        study = self.studies[study_id]
+        if after is None:
+            after = self._tick()
+        wait_start = time.perf_counter() if self.metrics is not None else None
+        with study.poll_cond:
+            while study.synced < after:
+                if not study.polling:
+                    study.polling = True
+                    break
+                study.poll_cond.wait()
+            else:
+                if wait_start is not None:
+                    self.metrics.observe_lock_wait('study_poll', time.perf_counter() - wait_start)
+                return
+        if wait_start is not None:
+            self.metrics.observe_lock_wait('study_poll', time.perf_counter() - wait_start)
+
+        started = None
+        try:
+            started = self._tick()
+            if study.subscribe_id is None:
+                self._follow(study)
+            if study.subscribe_id is not None:
+                polled_at = time.monotonic()
+                messages = self._request('GET', '/studies/{}/subscribe/{}'.format(
+                    study_id, study.subscribe_id))
+                if not study.apply(messages):
+                    messages = self._replay(study)
+                if self.metrics is not None:
+                    self.metrics.observe_poll(len(messages))
+                if (self.snapshot_dir is not None
+                        and study.seq - study.snapshot_seq >= self.snapshot_interval):
+                    self._save_snapshot(study)
+                if self._replicas is not None:
+                    self._publish(study, polled_at)
+        except Exception:
+            started = None
+            raise
+        finally:
+            with study.poll_cond:
+                study.polling = False
+                if started is not None:
+                    study.synced = max(study.synced, started)
+                    study.synced_at = time.time()
+                study.poll_cond.notify_all()
+
+    def _sync(self, study_id):
+        # With a background subscriber the replica is kept current, so a read only has to poll
+        # when one of our own writes may not be reflected yet.  Followers of a shared replica
+        # always check for a newer one (which is cheap when there is none).
+        self._connect()
+        study = self.studies[study_id]
+        if (self._subscriber is None or self._subscriber.error is not None
+                or study.subscribe_id is None):
+            self._poll(study_id)
+        else:
+            self._poll(study_id, study.dirty_after)
+        if self.metrics is not None:
+            self.metrics.observe_replica_lag(time.time() - study.synced_at)
+
+    def _sync_trial(self, study_id, trial_id):
+        # A trial created by another worker may not have reached the replica yet even while the
+        # subscriber is running, so an unknown trial is looked for with a fresh poll.
+        self._sync(study_id)
+        if trial_id not in self.studies[study_id].trials:
+            self._mark_dirty(study_id)
+            self._poll(study_id)
+
+    def get_replica_seq(self, study_id):
+        """Returns the number of messages applied to the local replica of the study."""
+
+        return self.studies[study_id].seq
+
+    def wait_for_seq(self, study_id, seq, timeout=None):
+        """Blocks until the local replica has applied at least ``seq`` messages.
+
+        Returns ``False`` if ``timeout`` seconds passed first.
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        study = self.studies[study_id]
+        while study.seq < seq:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            self._poll(study_id)
+            if study.seq < seq:
+                time.sleep(DEFAULT_POLL_INTERVAL)
+        return True
 
     def _study_id(self, trial_id):
         return trial_id.split('.')[0]
@@ -99,7 +517,8 @@ class PlumtunaStorage(base.BaseStorage):
     def set_study_user_attr(self, study_id, key, value):
         # type: (int, str, Any) -> None
 
-        self._put('/studies/{}/user_attrs/{}'.format(study_id, urllib.parse.quote_plus(key)), value)
+        self._write_study(study_id, '/studies/{}/user_attrs/{}'.format(study_id, urllib.parse.quote_plus(key)),
+                          value)
 
     def set_study_direction(self, study_id, direction):
         # type: (int, structs.StudyDirection) -> None
@@ -111,12 +530,13 @@ class PlumtunaStorage(base.BaseStorage):
         else:
             d = "MAXIMIZE"
 
-        self._put('/studies/{}/direction'.format(study_id), d)
+        self._write_study(study_id, '/studies/{}/direction'.format(study_id), d)
 
     def set_study_system_attr(self, study_id, key, value):
         # type: (int, str, Any) -> None
 
-        self._put('/studies/{}/system_attrs/{}'.format(study_id, urllib.parse.quote_plus(key)), value)
+        self._write_study(study_id, '/studies/{}/system_attrs/{}'.format(study_id, urllib.parse.quote_plus(key)),
+                          value)
 
     # Basic study access
 
@@ -138,7 +558,7 @@ class PlumtunaStorage(base.BaseStorage):
     def get_study_direction(self, study_id):
         # type: (int) -> structs.StudyDirection
 
-        self._poll(study_id)
+        self._sync(study_id)
         return self.studies[study_id].direction
         # d = self._get('/studies/{}/direction'.format(study_id))
         # if d == 'NOT_SET':
@@ -151,22 +571,23 @@ class PlumtunaStorage(base.BaseStorage):
     def get_study_user_attrs(self, study_id):
         # type: (int) -> Dict[str, Any]
 
-        self._poll(study_id)
+        self._sync(study_id)
         return copy.deepcopy(self.studies[study_id].user_attrs)
         # return self._get('/studies/{}/user_attrs'.format(study_id))
 
     def get_study_system_attrs(self, study_id):
         # type: (int) -> Dict[str, Any]
 
-        self._poll(study_id)
+        self._sync(study_id)
         return copy.deepcopy(self.studies[study_id].system_attrs)
         # return self._get('/studies/{}/system_attrs'.format(study_id))
 
     def get_all_study_summaries(self):
         # type: () -> List[structs.StudySummary]
 
-        self._poll(study_id)
-        return [s.summary() for s in self.studies.values()]
+        for study_id in list(self.studies):
+            self._sync(study_id)
+        return [s.summary() for s in list(self.studies.values())]
         # return self._get('/studies')
 
     # Basic trial manipulation
@@ -174,51 +595,58 @@ class PlumtunaStorage(base.BaseStorage):
     def create_new_trial_id(self, study_id):
         # type: (int) -> int
 
-        return self._post('/studies/{}/trials'.format(study_id))
+        trial_id = self._post('/studies/{}/trials'.format(study_id))
+        self._mark_dirty(study_id)
+        return trial_id
 
     def set_trial_state(self, trial_id, state):
         # type: (int, structs.TrialState) -> None
 
         s = trial_state_to_str(state)
-        self._put('/trials/{}/state'.format(trial_id), s)
+        self._put_trial(trial_id, '/trials/{}/state'.format(trial_id), s)
+        self._flush_writes(self._study_id(trial_id), trial_id)
 
     def set_trial_param(self, trial_id, param_name, param_value_internal, distribution):
         # type: (int, str, float, distributions.BaseDistribution) -> bool
 
-        self._put('/trials/{}/params/{}'.format(trial_id, param_name),
-                  {'value': param_value_internal,
-                   'distribution': distributions.distribution_to_json(distribution)})
+        self._put_trial(trial_id, '/trials/{}/params/{}'.format(trial_id, param_name),
+                        {'value': param_value_internal,
+                         'distribution': distributions.distribution_to_json(distribution)})
         return True
 
     def get_trial_param(self, trial_id, param_name):
         # type: (int, str) -> float
 
         study_id = self._study_id(trial_id)
-        self._poll(study_id)
-        return self.studies[study_id].trials[trial_id].trial_params[param_name]
+        self._flush_writes(study_id, trial_id)
+        self._sync_trial(study_id, trial_id)
+        return self.studies[study_id].trials[trial_id].params_in_internal_repr[param_name]
 
         # return self._get('/trials/{}/params/{}'.format(trial_id, param_name))
 
     def set_trial_value(self, trial_id, value):
         # type: (int, float) -> None
 
-        self._put('/trials/{}/value'.format(trial_id), value)
+        self._put_trial(trial_id, '/trials/{}/value'.format(trial_id), value)
 
     def set_trial_intermediate_value(self, trial_id, step, intermediate_value):
         # type: (int, int, float) -> bool
 
-        self._put('/trials/{}/intermediate_values/{}'.format(trial_id, step), intermediate_value)
+        self._put_trial(trial_id, '/trials/{}/intermediate_values/{}'.format(trial_id, step),
+                        intermediate_value)
         return True
 
     def set_trial_user_attr(self, trial_id, key, value):
         # type: (int, str, Any) -> None
 
-        self._put('/trials/{}/user_attrs/{}'.format(trial_id, urllib.parse.quote_plus(key)), value)
+        self._put_trial(trial_id, '/trials/{}/user_attrs/{}'.format(trial_id, urllib.parse.quote_plus(key)),
+                        value)
 
     def set_trial_system_attr(self, trial_id, key, value):
         # type: (int, str, Any) -> None
 
-        self._put('/trials/{}/system_attrs/{}'.format(trial_id, urllib.parse.quote_plus(key)), value)
+        self._put_trial(trial_id, '/trials/{}/system_attrs/{}'.format(trial_id, urllib.parse.quote_plus(key)),
+                        value)
 
     # Basic trial access
 
@@ -226,26 +654,212 @@ class PlumtunaStorage(base.BaseStorage):
         # type: (int) -> structs.FrozenTrial
 
         study_id = self._study_id(trial_id)
-        self._poll(study_id)
-        return copy.deepcopy(self.studies[study_id].trials[trial_id])
+        self._flush_writes(study_id, trial_id)
+        self._sync_trial(study_id, trial_id)
+        return self._trial(self.studies[study_id], trial_id)
         # return dict_to_trial(self._get('/trials/{}'.format(trial_id)))
 
     def get_all_trials(self, study_id):
         # type: (int) -> List[structs.FrozenTrial]
 
-        self._poll(study_id)
-        return [copy.deepcopy(t) for t in self.studies[study_id].trials.values()]
+        self._flush_writes(study_id)
+        self._sync(study_id)
+        study = self.studies[study_id]
+        trials = study.all_trials()
+        if study.n_evicted():
+            # The detail of evicted trials is fetched without restoring it into the replica,
+            # trial by trial unless that would take more requests than it saves.
+            positions = study.evicted_positions()
+            if len(positions) * _MAX_FETCH_RATIO <= len(trials):
+                for i in positions:
+                    trials[i] = dict_to_trial(self._get('/trials/{}'.format(trials[i].trial_id)))
+            else:
+                fetched = dict((t['trial_id'], t)
+                               for t in self._get('/studies/{}/trials'.format(study_id)))
+                for i in positions:
+                    trials[i] = dict_to_trial(fetched[trials[i].trial_id])
+        return trials
 
         # return [dict_to_trial(t) for t in self._get('/studies/{}/trials'.format(study_id))]
 
     def get_n_trials(self, study_id, state=None):
         # type: (int, Optional[structs.TrialState]) -> int
 
-        # TODO
-        if state is None:
-            return self._get('/studies/{}/n_trials'.format(study_id))
-        else:
-            return self._get('/studies/{}/n_trials?state={}'.format(study_id, trial_state_to_str(state)))
+        self._sync(study_id)
+        return self.studies[study_id].n_trials(state)
+
+        # if state is None:
+        #     return self._get('/studies/{}/n_trials'.format(study_id))
+        # else:
+        #     return self._get('/studies/{}/n_trials?state={}'.format(study_id, trial_state_to_str(state)))
+
+    def get_best_trial(self, study_id):
+        # type: (int) -> structs.FrozenTrial
+
+        self._flush_writes(study_id)
+        self._sync(study_id)
+        study = self.studies[study_id]
+        best_trial = study.best_trial()
+        if best_trial is None:
+            raise ValueError('No trials are completed yet.')
+        return self._trial(study, best_trial.trial_id)
+
+    def _trial(self, study, trial_id):
+        # Returns the trial from the replica, re-fetching its detail if it was evicted.
+        trial = study.trial(trial_id)
+        if trial is None:
+            trial = study.restore_detail(dict_to_trial(self._get('/trials/{}'.format(trial_id))))
+        return trial
+
+    def get_intermediate_values_at_step(self, study_id, step, state=None):
+        # type: (int, int, Optional[structs.TrialState]) -> array.array
+
+        self._flush_writes(study_id)
+        self._sync(study_id)
+        return self.studies[study_id].step_values(step, state)
+
+    def get_intermediate_percentile(self, study_id, step, q, state=structs.TrialState.COMPLETE):
+        # type: (int, int, float, Optional[structs.TrialState]) -> Optional[float]
+
+        self._flush_writes(study_id)
+        self._sync(study_id)
+        return self.studies[study_id].step_percentile(step, q, state)
+
+    def get_intermediate_median(self, study_id, step, state=structs.TrialState.COMPLETE):
+        # type: (int, int, Optional[structs.TrialState]) -> Optional[float]
+
+        return self.get_intermediate_percentile(study_id, step, 50.0, state)
+
+    def get_best_intermediate_result_over_steps(self, trial_id):
+        # type: (int) -> float
+
+        # As optuna's, the smallest value ignoring NaN; NaN if all values are NaN and ValueError
+        # if there are none.
+        values = self.get_trial(trial_id).intermediate_values.values()
+        if not values:
+            raise ValueError('No intermediate values have been reported.')
+        return min((v for v in values if v is not None and not math.isnan(v)), default=_NAN)
+
+    def get_median_intermediate_result_over_trials(self, study_id, step):
+        # type: (int, int) -> float
+
+        # As optuna's, the median of the values of completed trials at the step ignoring NaN;
+        # NaN if there are none, and ValueError if no trial is completed.
+        self._flush_writes(study_id)
+        self._sync(study_id)
+        study = self.studies[study_id]
+        if study.n_trials(structs.TrialState.COMPLETE) == 0:
+            raise ValueError('No trials have been completed.')
+        median = study.step_percentile(step, 50.0)
+        return _NAN if median is None else median
+
+    def get_value_quantile(self, study_id, q):
+        # type: (int, float) -> Optional[float]
+
+        self._flush_writes(study_id)
+        self._sync(study_id)
+        return self.studies[study_id].value_quantile(q)
+
+    def get_trial_table(self, study_id):
+        """Returns the trials of the study as :class:`~plumtuna.table.TrialArrays` of NumPy arrays.
+
+        The arrays are copied from a columnar table that the replica keeps current once this has
+        been called for the study, so no ``FrozenTrial`` is built.
+        """
+
+        self._flush_writes(study_id)
+        self._sync(study_id)
+        return self.studies[study_id].table()
+
+    # Bulk import/export
+
+    def export_trials(self, study_id, batch_size=DEFAULT_BULK_BATCH_SIZE):
+        """Yields the trials of the study as dicts in the format of ``GET /trials/{trial_id}``.
+
+        Trials are read from the local replica, ``batch_size`` at a time.
+        """
+
+        self._flush_writes(study_id)
+        self._sync(study_id)
+        study = self.studies[study_id]
+        records = study.records()
+        for i in range(0, len(records), batch_size):
+            with study.lock:
+                batch = [(r.trial_id, None if r.intermediate_values is None else _record_to_dict(r))
+                         for r in records[i:i + batch_size]]
+            for trial_id, d in batch:
+                yield d if d is not None else self._get('/trials/{}'.format(trial_id))
+
+    def import_trials(self, study_id, trials, batch_size=DEFAULT_BULK_BATCH_SIZE,
+                      n_workers=DEFAULT_POOL_SIZE):
+        """Creates a trial for each dict of ``trials`` (see :meth:`export_trials`).
+
+        ``trials`` may be any iterable; it is consumed ``batch_size`` trials at a time.  The
+        trials of a batch are created one after the other, so that the new trials are in the
+        order of ``trials``; then their fields are sent from ``n_workers`` threads.  The new
+        trials are started and completed at import time.  Returns the ids of the new trials.
+        """
+
+        trial_ids = []
+        trials = iter(trials)
+        with ThreadPoolExecutor(n_workers) as executor:
+            while True:
+                batch = list(itertools.islice(trials, batch_size))
+                if not batch:
+                    break
+                batch_ids = [self._post('/studies/{}/trials'.format(study_id)) for _ in batch]
+                for _ in executor.map(self._import_trial, batch_ids, batch):
+                    pass
+                trial_ids.extend(batch_ids)
+        self._mark_dirty(study_id)
+        return trial_ids
+
+    def _import_trial(self, trial_id, d):
+        prefix = '/trials/{}'.format(trial_id)
+        for name, p in d['params'].items():
+            self._put('{}/params/{}'.format(prefix, name),
+                      {'value': p['value'], 'distribution': p['distribution']})
+        if d['value'] is not None:
+            self._put(prefix + '/value', d['value'])
+        for step, value in d['intermediate_values'].items():
+            self._put('{}/intermediate_values/{}'.format(prefix, step), value)
+        for key, value in d['user_attrs'].items():
+            self._put('{}/user_attrs/{}'.format(prefix, urllib.parse.quote_plus(key)), value)
+        for key, value in d['system_attrs'].items():
+            self._put('{}/system_attrs/{}'.format(prefix, urllib.parse.quote_plus(key)), value)
+        if d['state'] != 'RUNNING':
+            self._put(prefix + '/state', d['state'])
+
+    def dump_study(self, study_id, f):
+        """Writes the study to the binary file ``f`` as JSON lines.
+
+        The first line holds the study name, direction and attrs; every other line is a trial as
+        yielded by :meth:`export_trials`.
+        """
+
+        self._sync(study_id)
+        study = self.studies[study_id]
+        f.write(encode_json({
+            'study_name': study.study_name,
+            'direction': study.direction.name,
+            'user_attrs': study.user_attrs,
+            'system_attrs': study.system_attrs,
+        }) + b'\n')
+        for d in self.export_trials(study_id):
+            f.write(encode_json(d) + b'\n')
+
+    def load_study(self, f, study_name=None):
+        """Creates a study from a file written by :meth:`dump_study` and returns its id."""
+
+        header = decode_json(f.readline())
+        study_id = self.create_new_study_id(study_name or header['study_name'])
+        self.set_study_direction(study_id, _STUDY_DIRECTIONS[header['direction']])
+        for key, value in header['user_attrs'].items():
+            self.set_study_user_attr(study_id, key, value)
+        for key, value in header['system_attrs'].items():
+            self.set_study_system_attr(study_id, key, value)
+        self.import_trials(study_id, (decode_json(line) for line in f if line.strip()))
+        return study_id
 
 
 def trial_state_to_str(state):
@@ -268,11 +882,30 @@ def str_to_trial_state(s):
     else:
         return structs.TrialState.FAIL
 
+_NAN = float('nan')
+
+# `get_all_trials` fetches evicted trials one by one while at most one in this many trials of
+# the study is evicted, and all trials of the study at once otherwise.
+_MAX_FETCH_RATIO = 10
+
+_DIGEST_STRIDE = 8  # see `_digest`
+
+_STUDY_DIRECTIONS = {
+    'NOT_SET': structs.StudyDirection.NOT_SET,
+    'MINIMIZE': structs.StudyDirection.MINIMIZE,
+    'MAXIMIZE': structs.StudyDirection.MAXIMIZE,
+}
+
+@functools.lru_cache(maxsize=1024)
+def json_to_distribution(s):
+    # A study only uses a handful of distributions, so each JSON payload is decoded once.
+    return distributions.json_to_distribution(s)
+
 def dict_to_trial(d):
     params = {}
     params_in_internal_repr = {}
     for k,v in d['params'].items():
-        distribution = distributions.json_to_distribution(v['distribution'])
+        distribution = json_to_distribution(v['distribution'])
         params[k] = distribution.to_external_repr(v['value'])
         params_in_internal_repr[k] = v['value']
 
@@ -289,74 +922,546 @@ def dict_to_trial(d):
         datetime_complete=datetime.fromtimestamp(d['datetime_end']) if d['datetime_end'] else None,
     )
 
+def _digest(messages, position, crc):
+    # Covers every `_DIGEST_STRIDE`th message of the study's history, `messages` starting at
+    # `position`: digesting all of them would cost about as much as applying them.  With one
+    # `repr` per batch and a separator after it, the CRC doesn't depend on the batch sizes.
+    sample = messages[-position % _DIGEST_STRIDE::_DIGEST_STRIDE]
+    if sample:
+        crc = zlib.crc32(repr(sample)[1:-1].encode('utf-8') + b', ', crc)
+    return crc
+
+
+def _record_to_dict(r):
+    # The inverse of `dict_to_trial`.
+    return {
+        'trial_id': r.trial_id,
+        'state': trial_state_to_str(r.state),
+        'value': r.value,
+        'params': dict((k, {'value': v, 'distribution': r.param_distributions[k]})
+                       for k, v in r.params_in_internal_repr.items()),
+        'intermediate_values': dict((str(k), v) for k, v in r.intermediate_values.items()),
+        'user_attrs': dict(r.user_attrs),
+        'system_attrs': dict(r.system_attrs),
+        'datetime_start': r.datetime_start.timestamp() if r.datetime_start else None,
+        'datetime_end': r.datetime_complete.timestamp() if r.datetime_complete else None,
+    }
+
+class _TrialRecord(object):
+    """Mutable replica of a trial.  :meth:`freeze` materializes (and caches) a ``FrozenTrial``."""
+
+    __slots__ = ('trial_id', 'state', 'value', 'datetime_start', 'datetime_complete', 'params',
+                 'params_in_internal_repr', 'param_distributions', 'intermediate_values',
+                 'user_attrs', 'system_attrs', 'seq', 'frozen')
+
+    def __init__(self, trial_id):
+        self.trial_id = trial_id
+        self.state = structs.TrialState.RUNNING
+        self.value = None
+        self.datetime_start = None
+        self.datetime_complete = None
+        self.params = {}
+        self.params_in_internal_repr = {}
+        self.param_distributions = {}  # param name -> distribution JSON
+        self.intermediate_values = {}
+        self.user_attrs = {}
+        self.system_attrs = {}
+        self.seq = 0  # `seq` of the study after the latest message that touched the trial
+        self.frozen = None
+
+    def freeze(self):
+        # The detail of an evicted record (see `StudyState._evict`) is left empty, and the result
+        # isn't cached.
+        if self.frozen is None:
+            frozen = structs.FrozenTrial(
+                trial_id=self.trial_id,
+                state=self.state,
+                params=dict(self.params),
+                user_attrs=dict(self.user_attrs or ()),
+                system_attrs=dict(self.system_attrs or ()),
+                value=self.value,
+                intermediate_values=dict(self.intermediate_values or ()),
+                params_in_internal_repr=dict(self.params_in_internal_repr),
+                datetime_start=self.datetime_start,
+                datetime_complete=self.datetime_complete,
+            )
+            if self.intermediate_values is None:
+                return frozen
+            self.frozen = frozen
+        return self.frozen
+
+
 class StudyState(object):
-    def __init__(self, study_id, study_name, subscribe_id):
+    """Local replica of a study, built from the messages of its subscription.
+
+    Trials are kept as mutable records and materialized to ``FrozenTrial`` snapshots only when
+    read; a snapshot is cached until a message touches its trial again.  Readers are handed the
+    cached snapshots (and the list returned by :meth:`all_trials`) without copying, so callers
+    must not mutate them.
+
+    Messages are applied under :attr:`lock`, which also guards the records and the indexes.
+    A published trial list is never modified afterwards, so :meth:`all_trials` only takes the
+    lock when trials changed since it was last called.
+
+    With ``max_details``, only that many finished trials keep their intermediate values and
+    attrs; the least recently used ones are evicted down to state, value and params (see
+    :meth:`trial` and :meth:`restore_detail`).  Their intermediate values stay in the step index,
+    but it isn't updated for messages that touch their detail after eviction (which optuna
+    doesn't send for finished trials); those are left for the re-fetch to pick up.  Only single
+    trials are restored: whole-study reads go back to the daemon for every evicted trial, so
+    this mode doesn't suit studies that samplers read.
+    """
+
+    def __init__(self, study_id, study_name, subscribe_id, max_details=None):
         self.study_id = study_id
         self.study_name = study_name
         self.subscribe_id = subscribe_id
-        self.trials = {}
+        self.lock = threading.RLock()
+        self.poll_cond = threading.Condition()
+        self.polling = False  # whether a poll of the subscription is in flight
+        self.seq = 0  # number of messages applied so far
+        self.skip = 0  # number of replayed messages already reflected by a loaded snapshot
+        self.digest = None  # CRC-32 of the applied messages, if tracked (see `_digest`)
+        self._replay_digest = 0  # same, of the skipped messages
+        self.snapshot_seq = 0  # `seq` at the time of the latest saved snapshot
+        self.synced = 0  # clock value at the start of the latest completed poll
+        self.synced_at = 0.0  # wall-clock time at which the latest poll completed
+        self.dirty_after = 0  # clock value of the latest acknowledged write
+        self.dirty_at = 0.0  # time.monotonic() of the latest acknowledged write
+        self.trials = {}  # trial_id -> _TrialRecord
         self.direction = structs.StudyDirection.NOT_SET
         self.user_attrs = {}
         self.system_attrs = {}
 
+        self._records = []  # in creation order
+        self._positions = {}  # trial_id -> position in `_records`
+        self._changed = set()  # positions in `_records` changed since the last publication
+        self._published_trials = []
+        self._summary = None
+
+        self._n_trials = collections.Counter()  # TrialState -> count
+        self._complete_values = []  # sorted (value, position) of completed trials
+        self._complete_keys = {}  # trial_id -> its entry in `_complete_values`
+        self._step_values = {}  # (TrialState, step) -> sorted array of intermediate values
+        self._step_nans = collections.Counter()  # (TrialState, step) -> number of NaN values
+        self._table = None  # TrialTable, built on the first call to `table`
+        self._distributions = {}  # distribution JSON -> the copy shared by the records
+        self._touched = None  # positions changed since `take_changes`, if tracked
+
+        self.max_details = max_details
+        self._detailed = collections.OrderedDict()  # finished trial_id -> None, in LRU order
+        self._n_evicted = 0
+
+    def apply(self, messages):
+        """Applies the messages of a poll.
+
+        With a ``digest`` (set to 0 to track it from the start, or loaded from a snapshot), the
+        skipped messages are checked against it: ``False`` is returned if they differ from the
+        messages that the loaded replica reflects, in which case the replica is unusable.
+        """
+
+        with self.lock:
+            if self.skip:
+                n = min(self.skip, len(messages))
+                if self.digest is not None:
+                    self._replay_digest = _digest(messages[:n], self.seq - self.skip,
+                                                  self._replay_digest)
+                messages = messages[n:]
+                self.skip -= n
+                if not self.skip and self.digest is not None:
+                    if self._replay_digest != self.digest:
+                        return False
+            position = self.seq
+            for m in messages:
+                self.handle_message(m)
+            if self.digest is not None:
+                self.digest = _digest(messages, position, self.digest)
+            return True
+
+    def skip_replayed(self):
+        """Skips the messages that the replica reflects when the subscription replays them."""
+
+        with self.lock:
+            self.skip = self.seq
+            self._replay_digest = 0
+
+    def records(self):
+        return list(self._records)
+
+    def load_records(self, records, seq):
+        """Restores trial records (e.g. from a snapshot) reflecting the first ``seq`` messages.
+
+        The subscription replays the study history from its beginning, so that many messages
+        are skipped by :meth:`apply`.
+        """
+
+        with self.lock:
+            for r in records:
+                self.trials[r.trial_id] = r
+                self._positions[r.trial_id] = len(self._records)
+                self._records.append(r)
+                self._n_trials[r.state] += 1
+                self._index_value(r)
+                for step, value in r.intermediate_values.items():
+                    self._index_step(r.state, step, value)
+            self.seq = self.snapshot_seq = seq
+            self.skip_replayed()
+
+    def update_records(self, records, seq):
+        """Replaces (or adds) the records of trials, e.g. from a published delta, as of ``seq``."""
+
+        with self.lock:
+            for r in records:
+                old = self.trials.get(r.trial_id)
+                if old is r:
+                    continue
+                if old is None:
+                    position = self._positions[r.trial_id] = len(self._records)
+                    self._records.append(r)
+                    if self._table is not None:
+                        self._table.add_trial(r.trial_id)
+                else:
+                    position = self._positions[r.trial_id]
+                    self._records[position] = r
+                    self._n_trials[old.state] -= 1
+                    for step, value in old.intermediate_values.items():
+                        self._unindex_step(old.state, step, value)
+                    self._changed.add(position)
+                self.trials[r.trial_id] = r
+                self._n_trials[r.state] += 1
+                self._index_value(r)
+                for step, value in r.intermediate_values.items():
+                    self._index_step(r.state, step, value)
+                if self._table is not None:
+                    self._table.set_record(position, r)
+            self.seq = seq
+
+    def track_changes(self):
+        """Starts recording which trials change, for :meth:`take_changes`."""
+
+        with self.lock:
+            self._touched = set()
+
+    def take_changes(self):
+        """Returns the records of the trials changed since the previous call, in creation order."""
+
+        with self.lock:
+            touched, self._touched = self._touched, set()
+            return [self._records[i] for i in sorted(touched)]
+
+    def load_state(self, other):
+        """Replaces the replicated contents with those of ``other`` (e.g. a reloaded snapshot)."""
+
+        with self.lock:
+            for name in self._CONTENTS:
+                setattr(self, name, getattr(other, name))
+
+    _CONTENTS = ('seq', 'skip', 'digest', 'trials', 'direction', 'user_attrs', 'system_attrs', '_records',
+                 '_positions', '_changed', '_published_trials', '_summary', '_n_trials',
+                 '_complete_values', '_complete_keys', '_step_values', '_step_nans', '_table',
+                 '_distributions')
+
+    def trial(self, trial_id):
+        """Returns the trial, or ``None`` if its detail was evicted."""
+
+        record = self.trials[trial_id]
+        frozen = record.frozen
+        if frozen is None or self.max_details is not None:
+            with self.lock:
+                if record.intermediate_values is None:
+                    return None
+                if trial_id in self._detailed:
+                    self._detailed.move_to_end(trial_id)
+                frozen = record.freeze()
+        return frozen
+
+    def restore_detail(self, trial):
+        """Puts the detail of a re-fetched ``FrozenTrial`` back into its evicted record."""
+
+        with self.lock:
+            record = self.trials[trial.trial_id]
+            if record.intermediate_values is None:
+                record.intermediate_values = dict(trial.intermediate_values)
+                record.user_attrs = dict(trial.user_attrs)
+                record.system_attrs = dict(trial.system_attrs)
+                self._n_evicted -= 1
+                self._keep_detail(record)
+            return trial
+
+    def n_evicted(self):
+        return self._n_evicted
+
+    def evicted_positions(self):
+        """Returns the positions (in creation order) of the trials whose detail was evicted."""
+
+        with self.lock:
+            return [i for i, r in enumerate(self._records) if r.intermediate_values is None]
+
+    def all_trials(self):
+        if self._changed or len(self._published_trials) != len(self._records):
+            with self.lock:
+                self._publish()
+        return list(self._published_trials)  # callers (e.g. samplers) may sort it in place
+
+    def _publish(self):
+        trials = list(self._published_trials)
+        for i in self._changed:
+            if i < len(trials):
+                trials[i] = self._records[i].freeze()
+        trials.extend(r.freeze() for r in self._records[len(trials):])
+        self._changed = set()
+        self._published_trials = trials
+
+    def n_trials(self, state=None):
+        if state is None:
+            return len(self._records)
+        return self._n_trials[state]
+
+    def best_trial(self):
+        with self.lock:
+            if not self._complete_values:
+                return None
+            # Like `BaseStorage.get_best_trial`, ties go to the first trial in creation order.
+            if self.direction == structs.StudyDirection.MAXIMIZE:
+                best = self._complete_values[-1][0]
+                _, position = self._complete_values[
+                    bisect.bisect_left(self._complete_values, (best,))]
+            else:
+                _, position = self._complete_values[0]
+            return self._records[position].freeze()
+
+    def value_quantile(self, q):
+        """Returns the ``q``-quantile (nearest rank) of the values of the completed trials."""
+
+        with self.lock:
+            if not self._complete_values:
+                return None
+            i = min(int(q * len(self._complete_values)), len(self._complete_values) - 1)
+            return self._complete_values[i][0]
+
+    def summary(self):
+        with self.lock:
+            if self._summary is None or self._summary[0] != self.seq:
+                starts = [r.datetime_start for r in self._records if r.datetime_start is not None]
+
+                summary = structs.StudySummary(
+                    study_name=self.study_name,
+                    direction=self.direction,
+                    best_trial=self.best_trial(),
+                    user_attrs=copy.deepcopy(self.user_attrs),
+                    system_attrs=copy.deepcopy(self.system_attrs),
+                    n_trials=len(self._records),
+                    datetime_start=min(starts) if starts else None,
+                    study_id=self.study_id,
+                )
+                self._summary = (self.seq, summary)
+            return self._summary[1]
+
+    def step_values(self, step, state=None):
+        """Returns the sorted intermediate values reported at ``step`` as an ``array('d')``.
+
+        As with ``numpy.sort``, NaN values come last.
+        """
+
+        with self.lock:
+            states = list(structs.TrialState) if state is None else [state]
+            values = self._sorted_step_values(step, states)
+            n_nans = sum(self._step_nans[(s, step)] for s in states)
+            if n_nans:
+                values.extend(array.array('d', [_NAN]) * n_nans)
+            return values
+
+    def step_percentile(self, step, q, state=structs.TrialState.COMPLETE):
+        """Returns the ``q``-th percentile (0 to 100, linearly interpolated) at ``step``.
+
+        NaN values are ignored, as by ``numpy.nanpercentile``.
+        """
+
+        with self.lock:
+            states = list(structs.TrialState) if state is None else [state]
+            values = self._sorted_step_values(step, states)
+            if not values:
+                return None
+            rank = (len(values) - 1) * q / 100.0
+            lower = int(rank)
+            upper = min(lower + 1, len(values) - 1)
+            return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+    def _sorted_step_values(self, step, states):
+        if len(states) == 1:
+            return array.array('d', self._step_values.get((states[0], step), ()))
+        columns = [self._step_values.get((s, step), ()) for s in states]
+        return array.array('d', heapq.merge(*columns))
+
+    def table(self):
+        """Returns the trials as :class:`~plumtuna.table.TrialArrays`.
+
+        The underlying :class:`~plumtuna.table.TrialTable` is built on the first call and then
+        updated along with the records.
+        """
+
+        with self.lock:
+            if self._table is None:
+                self._table = TrialTable.from_records(self._records)
+            return self._table.to_numpy()
+
     def handle_message(self, message):
+        self.seq += 1
         kind, v = next(iter(message.items()))
-        if kind == 'SetStudyDirection':
-            d = v['direction']
-            if d == 'NOT_SET':
-                self.direction = structs.StudyDirection.NOT_SET
-            elif d == 'MINIMIZE':
-                self.direction = structs.StudyDirection.MINIMIZE
-            else:
-                self.direction = structs.StudyDirection.MAXIMIZE
-        elif kind == 'SetStudyUserAttr':
-            self.user_attrs[v['key']] = v['value']
-        elif kind == 'SetStudySystemAttr':
-            self.system_attrs[v['key']] = v['value']
-        elif kind == 'CreateTrial':
-            t = self._trial(v['trial_id'])
-            self.trials[t.trial_id] = t._replace(datetime_start=datetime.fromtimestamp(v['timestamp']['secs']))  # TODO: nanos
-        elif kind == 'SetTrialState':
-            t = self._trial(v['trial_id'])
-            t = t._replace(state=str_to_trial_state(v['state']))
-            if v['state'] != 'RUNNING':
-                t = t._replace(datetime_complete=datetime.fromtimestamp(v['timestamp']['secs']))  # TODO: nanos
-            self.trials[t.trial_id] = t
-        elif kind == 'SetTrialParam':
-            t = self._trial(v['trial_id'])
-            distribution = distributions.json_to_distribution(v['value']['distribution'])
-            t.params[v['key']] = distribution.to_external_repr(v['value']['value'])
-            t.params_in_internal_repr[v['key']] = v['value']['value']
-        elif kind == 'SetTrialValue':
-            t = self._trial(v['trial_id'])
-            self.trials[t.trial_id] = t._replace(value=v['value'])
-        elif kind == 'SetTrialIntermediateValue':
-            t = self._trial(v['trial_id'])
-            t.intermediate_values[v['step']] = v['value']
-        elif kind == 'SetTrialUserAttr':
-            t = self._trial(v['trial_id'])
+        handler = self._HANDLERS.get(kind)
+        if handler is None:
+            raise NotImplementedError(str(message))
+        handler(self, v)
+
+    def _set_study_direction(self, v):
+        self.direction = _STUDY_DIRECTIONS.get(v['direction'], structs.StudyDirection.MAXIMIZE)
+
+    def _set_study_user_attr(self, v):
+        user_attrs = dict(self.user_attrs)
+        user_attrs[v['key']] = v['value']
+        self.user_attrs = user_attrs
+
+    def _set_study_system_attr(self, v):
+        system_attrs = dict(self.system_attrs)
+        system_attrs[v['key']] = v['value']
+        self.system_attrs = system_attrs
+
+    def _create_trial(self, v):
+        t = self._trial(v['trial_id'])
+        t.datetime_start = datetime.fromtimestamp(v['timestamp']['secs'])  # TODO: nanos
+
+    def _set_trial_state(self, v):
+        t = self._trial(v['trial_id'])
+        state = str_to_trial_state(v['state'])
+        if state != t.state:
+            self._n_trials[t.state] -= 1
+            self._n_trials[state] += 1
+            for step, value in (t.intermediate_values or {}).items():
+                self._unindex_step(t.state, step, value)
+                self._index_step(state, step, value)
+            t.state = state
+            self._index_value(t)
+            if self._table is not None:
+                self._table.states[self._positions[t.trial_id]] = state.value
+        if state != structs.TrialState.RUNNING:
+            t.datetime_complete = datetime.fromtimestamp(v['timestamp']['secs'])  # TODO: nanos
+            if self.max_details is not None and t.intermediate_values is not None:
+                self._keep_detail(t)
+
+    def _set_trial_param(self, v):
+        t = self._trial(v['trial_id'])
+        distribution = json_to_distribution(v['value']['distribution'])
+        t.params[v['key']] = distribution.to_external_repr(v['value']['value'])
+        t.params_in_internal_repr[v['key']] = v['value']['value']
+        # Every trial repeats the same few distributions, so the replica keeps one copy of each.
+        t.param_distributions[v['key']] = self._distributions.setdefault(
+            v['value']['distribution'], v['value']['distribution'])
+        if self._table is not None:
+            self._table.set_param(self._positions[t.trial_id], v['key'], v['value']['value'])
+
+    def _set_trial_value(self, v):
+        t = self._trial(v['trial_id'])
+        t.value = v['value']
+        self._index_value(t)
+        if self._table is not None:
+            self._table.values[self._positions[t.trial_id]] = _NAN if t.value is None else t.value
+
+    def _set_trial_intermediate_value(self, v):
+        t = self._trial(v['trial_id'])
+        if self._table is not None:
+            self._table.set_intermediate_value(self._positions[t.trial_id], v['step'], v['value'])
+        if t.intermediate_values is None:  # evicted
+            self._index_step(t.state, v['step'], v['value'])
+            return
+        old_value = t.intermediate_values.get(v['step'])
+        if old_value is not None:
+            self._unindex_step(t.state, v['step'], old_value)
+        self._index_step(t.state, v['step'], v['value'])
+        t.intermediate_values[v['step']] = v['value']
+
+    def _set_trial_user_attr(self, v):
+        t = self._trial(v['trial_id'])
+        if t.user_attrs is not None:
             t.user_attrs[v['key']] = v['value']
-        elif kind == 'SetTrialSystemAttr':
-            t = self._trial(v['trial_id'])
+
+    def _set_trial_system_attr(self, v):
+        t = self._trial(v['trial_id'])
+        if t.system_attrs is not None:
             t.system_attrs[v['key']] = v['value']
-        else:
-            raise NotImplementedError(str(message))
+
+    _HANDLERS = {
+        'SetStudyDirection': _set_study_direction,
+        'SetStudyUserAttr': _set_study_user_attr,
+        'SetStudySystemAttr': _set_study_system_attr,
+        'CreateTrial': _create_trial,
+        'SetTrialState': _set_trial_state,
+        'SetTrialParam': _set_trial_param,
+        'SetTrialValue': _set_trial_value,
+        'SetTrialIntermediateValue': _set_trial_intermediate_value,
+        'SetTrialUserAttr': _set_trial_user_attr,
+        'SetTrialSystemAttr': _set_trial_system_attr,
+    }
+
+    def _index_value(self, trial):
+        key = self._complete_keys.pop(trial.trial_id, None)
+        if key is not None:
+            del self._complete_values[bisect.bisect_left(self._complete_values, key)]
+        if (trial.state == structs.TrialState.COMPLETE and trial.value is not None
+                and not math.isnan(trial.value)):
+            key = (trial.value, self._positions[trial.trial_id])
+            bisect.insort(self._complete_values, key)
+            self._complete_keys[trial.trial_id] = key
+
+    def _index_step(self, state, step, value):
+        # NaN values are only counted: they have no place in a sorted array.
+        if value is None:
+            return
+        if math.isnan(value):
+            self._step_nans[(state, step)] += 1
+            return
+        column = self._step_values.get((state, step))
+        if column is None:
+            column = self._step_values[(state, step)] = array.array('d')
+        bisect.insort(column, value)
+
+    def _unindex_step(self, state, step, value):
+        if value is None:
+            return
+        if math.isnan(value):
+            self._step_nans[(state, step)] -= 1
+            return
+        column = self._step_values[(state, step)]
+        del column[bisect.bisect_left(column, value)]
+
+    def _keep_detail(self, record):
+        self._detailed[record.trial_id] = None
+        self._detailed.move_to_end(record.trial_id)
+        while len(self._detailed) > self.max_details:
+            trial_id, _ = self._detailed.popitem(last=False)
+            self._evict(self.trials[trial_id])
+
+    def _evict(self, record):
+        # Drops the intermediate values and attrs of a finished trial from the replica.
+        record.intermediate_values = record.user_attrs = record.system_attrs = None
+        record.frozen = None
+        self._n_evicted += 1
+        self._changed.add(self._positions[record.trial_id])
+        self._published_trials = []  # don't hold on to the evicted detail
 
     def _trial(self, trial_id):
-        if trial_id in self.trials:
-            return self.trials[trial_id]
-
-        trial = structs.FrozenTrial(
-            trial_id=trial_id,
-            state=structs.TrialState.RUNNING,
-            params={},
-            user_attrs={},
-            system_attrs={},
-            value=None,
-            intermediate_values={},
-            params_in_internal_repr={},
-            datetime_start=None,
-            datetime_complete=None
-        )
-        self.trials[trial_id] = trial
-        return trial
+        # Returns the record of the trial, marking it as changed.
+        record = self.trials.get(trial_id)
+        if record is None:
+            record = self.trials[trial_id] = _TrialRecord(trial_id)
+            self._positions[trial_id] = len(self._records)
+            self._records.append(record)
+            self._n_trials[record.state] += 1
+            if self._table is not None:
+                self._table.add_trial(trial_id)
+        else:
+            record.frozen = None
+            self._changed.add(self._positions[trial_id])
+        if self._touched is not None:
+            self._touched.add(self._positions[trial_id])
+        record.seq = self.seq
+        return record
@@ -0,0 +1,50 @@
+import logging
+import threading
+
+DEFAULT_POLL_INTERVAL = 0.1  # seconds
+
+_logger = logging.getLogger(__name__)
+
+
+class Subscriber(object):
+    """Keeps study replicas current by polling their subscriptions from a background thread.
+
+    ``poll`` is called with each study id returned by ``study_ids`` once per ``interval``.  A
+    poll that raises is logged and retried on the next round; until a round succeeds again, the
+    exception is kept in :attr:`error` and callers are expected to poll synchronously, which
+    will surface the failure to them.
+    """
+
+    def __init__(self, poll, study_ids, interval=DEFAULT_POLL_INTERVAL):
+        self._poll = poll
+        self._study_ids = study_ids
+        self.interval = interval
+        self.error = None
+        self._stop = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name='plumtuna-subscriber', daemon=True)
+        self._thread.start()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            error = None
+            try:
+                study_ids = self._study_ids()
+            except Exception as e:
+                study_ids, error = [], e
+                _logger.warning('plumtuna subscriber failed to list studies', exc_info=True)
+            for study_id in study_ids:
+                try:
+                    self._poll(study_id)
+                except Exception as e:
+                    error = e
+                    _logger.warning('plumtuna subscriber failed to poll study %s', study_id,
+                                    exc_info=True)
+            self.error = error
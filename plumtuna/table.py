@@ -0,0 +1,99 @@
+"""Columnar view of the trials of a study replica.
+
+A :class:`TrialTable` is built from a :class:`~plumtuna.storage.StudyState` the first time it
+is asked for and then kept current by the same messages that update the replica, one array
+element per field.  :meth:`TrialTable.to_numpy` copies it out as NumPy arrays; rows are trials
+in creation order.
+"""
+
+import array
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_NAN = float('nan')
+
+TrialArrays = collections.namedtuple('TrialArrays', (
+    'trial_ids',  # list of trial ids
+    'states',  # int8, TrialState values
+    'values',  # float64, NaN if unset
+    'param_names',  # list of names, sorted
+    'params',  # float64 (n_trials, n_params) in internal representation, NaN if unset
+    'steps',  # int64, sorted
+    'intermediate_values',  # float64 (n_steps, n_trials), NaN if unset
+))
+
+
+class TrialTable(object):
+    def __init__(self):
+        self.trial_ids = []
+        self.states = array.array('b')
+        self.values = array.array('d')
+
+        # name or step -> column; columns only grow up to the last row that was set
+        self.params = {}
+        self.intermediate_values = {}
+
+    @classmethod
+    def from_records(cls, records):
+        table = cls()
+        for i, r in enumerate(records):
+            table.add_trial(r.trial_id)
+            table.set_record(i, r)
+        return table
+
+    def add_trial(self, trial_id):
+        self.trial_ids.append(trial_id)
+        self.states.append(0)  # RUNNING
+        self.values.append(_NAN)
+
+    def set_record(self, i, record):
+        self.states[i] = record.state.value
+        self.values[i] = _NAN if record.value is None else record.value
+        for name, value in record.params_in_internal_repr.items():
+            self.set_param(i, name, value)
+        for step, value in (record.intermediate_values or {}).items():
+            self.set_intermediate_value(i, step, value)
+
+    def set_param(self, i, name, value):
+        _set(self.params, name, i, value)
+
+    def set_intermediate_value(self, i, step, value):
+        _set(self.intermediate_values, step, i, _NAN if value is None else value)
+
+    def to_numpy(self):
+        if numpy is None:
+            raise ImportError('TrialTable.to_numpy requires numpy')
+
+        n = len(self.trial_ids)
+        param_names = sorted(self.params)
+        params = numpy.full((n, len(param_names)), numpy.nan)
+        for j, name in enumerate(param_names):
+            column = self.params[name]
+            params[:len(column), j] = numpy.frombuffer(column, dtype=numpy.float64)
+        steps = sorted(self.intermediate_values)
+        intermediate_values = numpy.full((len(steps), n), numpy.nan)
+        for j, step in enumerate(steps):
+            column = self.intermediate_values[step]
+            intermediate_values[j, :len(column)] = numpy.frombuffer(column, dtype=numpy.float64)
+        return TrialArrays(
+            trial_ids=list(self.trial_ids),
+            states=numpy.frombuffer(self.states, dtype=numpy.int8).copy(),
+            values=numpy.frombuffer(self.values, dtype=numpy.float64).copy(),
+            param_names=param_names,
+            params=params,
+            steps=numpy.array(steps, dtype=numpy.int64),
+            intermediate_values=intermediate_values,
+        )
+
+
+def _set(columns, key, i, value):
+    column = columns.get(key)
+    if column is None:
+        column = columns[key] = array.array('d')
+    if len(column) <= i:
+        column.extend(array.array('d', [_NAN]) * (i + 1 - len(column)))
+    column[i] = value
@@ -0,0 +1,115 @@
+import json
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_TIMEOUT = (5.0, 60.0)  # (connect, read) seconds
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+BINARY_ACCEPT = '{}, {};q=0.5'.format(MSGPACK, JSON)  # MessagePack, or else JSON
+
+
+def decode_json(data):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:  # e.g. NaN, which orjson rejects
+            pass
+    return json.loads(data.decode('utf-8'))
+
+
+def encode_json(body):
+    # Not orjson: it rejects numpy scalars and non-str keys and turns NaN into null, all of
+    # which the json module handles the way callers (and optuna's own storages) expect.
+    return json.dumps(body).encode('utf-8')
+
+
+class BaseTransport(object):
+    """Carries storage requests to the local plumtuna daemon.
+
+    Implementations return ``(status_code, decoded_body)`` from :meth:`request`.
+    """
+
+    def request(self, method, path, body=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class HttpTransport(BaseTransport):
+    """Keep-alive HTTP transport backed by a shared connection pool.
+
+    ``requests.Session`` is not thread safe, so each thread gets its own session.  All of them
+    mount the same ``HTTPAdapter``, which means the sockets themselves are pooled across threads
+    and a warm call costs a single round trip.
+
+    Unless ``binary`` is ``False`` (or ``msgpack`` isn't installed) MessagePack responses are
+    requested via ``Accept``, with JSON as the fallback.  Request bodies are always JSON: they are
+    small, and MessagePack would keep the non-str keys and numpy scalars that JSON converts.
+
+    If ``metrics`` (a :class:`~plumtuna.metrics.Metrics`) is given, every request is recorded.
+    """
+
+    def __init__(self, host, port, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 binary=True, metrics=None):
+        self.base_url = 'http://{}:{}'.format(host, port)
+        self.timeout = timeout
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self._local = threading.local()
+        self._binary = binary and msgpack is not None
+        self.metrics = metrics
+        if self._binary:
+            self._accept = BINARY_ACCEPT
+        else:
+            self._accept = JSON
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.trust_env = False  # Never route loopback traffic through a proxy.
+            session.mount('http://', self._adapter)
+            session.headers['Accept'] = self._accept
+            self._local.session = session
+        return session
+
+    def request(self, method, path, body=None):
+        data = None
+        headers = None
+        if body is not None:
+            data = encode_json(body)
+            headers = {'Content-Type': JSON}
+        start = time.perf_counter() if self.metrics is not None else None
+        res = self._session().request(method, self.base_url + path, data=data, headers=headers,
+                                      timeout=self.timeout)
+        body = self._decode(res)
+        if start is not None:
+            self.metrics.observe_request(method, path, time.perf_counter() - start,
+                                         len(data) if data else 0, len(res.content))
+        return res.status_code, body
+
+    def _decode(self, res):
+        content_type = res.headers.get('Content-Type', '').split(';')[0].strip()
+        try:
+            if self._binary and content_type == MSGPACK:
+                return msgpack.unpackb(res.content, raw=False, strict_map_key=False)
+            return decode_json(res.content)
+        except ValueError:
+            return res.text
+
+    def close(self):
+        self._adapter.close()
@@ -0,0 +1,208 @@
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import queue
+import threading
+import time
+
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_BATCH_DELAY = 1.0  # seconds
+
+
+class WriteBuffer(object):
+    """Buffers trial mutations and sends them in batches.
+
+    The daemon has no batch endpoint, so every buffered write is still sent as its own request.
+    What the buffer saves is requests for overwritten values and waiting for each round trip:
+
+    * Writes are keyed by request path, so a value that is overwritten before a flush (e.g. the
+      same attribute set twice) is only sent once.
+    * A flush sends its writes from ``n_workers`` threads, except that state changes are sent
+      after all other writes of the flush, so a trial never looks finished before its value and
+      params have arrived.  Each path occurs once per flush and flushes don't overlap, so the
+      latest write of each path still wins.
+
+    The buffer is flushed when it holds ``batch_size`` writes, when the oldest pending write is
+    ``batch_delay`` seconds old (by a timer thread), or explicitly via :meth:`flush`.  The first
+    error raised by a timed flush is kept and re-raised from the next :meth:`put` or
+    :meth:`flush` call.
+    """
+
+    def __init__(self, send, batch_size=DEFAULT_BATCH_SIZE, batch_delay=DEFAULT_BATCH_DELAY,
+                 n_workers=1):
+        self._send = send
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._executor = ThreadPoolExecutor(n_workers) if n_workers > 1 else None
+        self._pending = {}  # study_id -> {trial_id -> OrderedDict(path -> body)}
+        self._n_pending = 0
+        self._oldest = None
+        self._timer = None
+        self._error = None
+        self._lock = threading.Lock()
+
+        # Serializes flushes so that writes of the same trial can't overtake each other.
+        self._flush_lock = threading.Lock()
+
+    def put(self, study_id, trial_id, path, body):
+        self._check()
+        with self._lock:
+            writes = self._pending.setdefault(study_id, {}).setdefault(trial_id, OrderedDict())
+            if path in writes:
+                del writes[path]
+            else:
+                self._n_pending += 1
+            writes[path] = body
+            if self._oldest is None:
+                self._oldest = time.time()
+                if self._timer is None:
+                    self._start_timer(self.batch_delay)
+            full = self._n_pending >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self, study_id=None, trial_id=None):
+        self._check()
+        with self._flush_lock:
+            writes = self._take(study_id, trial_id)
+            self._send_all([w for w in writes if not w[1].endswith('/state')])
+            self._send_all([w for w in writes if w[1].endswith('/state')])
+
+    def close(self):
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _send_all(self, writes):
+        if self._executor is None or len(writes) < 2:
+            for write in writes:
+                self._send(*write)
+        else:
+            for _ in self._executor.map(lambda write: self._send(*write), writes):
+                pass
+
+    def _start_timer(self, delay):
+        self._timer = threading.Timer(delay, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire(self):
+        with self._lock:
+            self._timer = None
+            if self._oldest is None:
+                return
+            remaining = self._oldest + self.batch_delay - time.time()
+            if remaining > 0:  # flushed meanwhile, and written to again since
+                self._start_timer(remaining)
+                return
+        try:
+            self.flush()
+        except Exception as e:
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+
+    def _check(self):
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _take(self, study_id, trial_id):
+        with self._lock:
+            if study_id is None:
+                studies = list(self._pending.values())
+                self._pending = {}
+            elif trial_id is None:
+                studies = [self._pending.pop(study_id, {})]
+            else:
+                trials = self._pending.get(study_id, {})
+                studies = [{trial_id: trials.pop(trial_id)}] if trial_id in trials else []
+
+            writes = []
+            for trials in studies:
+                for trial_id, trial_writes in trials.items():
+                    writes.extend((trial_id, path, body) for path, body in trial_writes.items())
+            self._n_pending -= len(writes)
+            if self._n_pending == 0:
+                self._oldest = None
+            return writes
+
+
+class AsyncWriter(object):
+    """Sends writes from a background thread so that callers don't wait for the daemon.
+
+    A single sender thread consumes the queue in FIFO order, so writes of a trial are applied
+    in the order they were issued.  The first error raised by the sender is kept and re-raised
+    from the next :meth:`wait` or :meth:`check` call.  Pending writes are drained on
+    :meth:`close`, which is also registered to run at interpreter exit.
+    """
+
+    def __init__(self, send):
+        self._send = send
+        self._queue = queue.Queue()
+        self._error = None
+        self._enqueued = 0
+        self._done = 0
+        self._last_seq = {}  # key -> seq of the latest write enqueued for it
+        self._cond = threading.Condition()
+        self._closed = False
+        self._pid = os.getpid()
+
+        self._thread = threading.Thread(target=self._run, name='plumtuna-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, key, path, body):
+        self.check()
+        with self._cond:
+            if self._closed:
+                self._send(key, path, body)
+                return
+            self._enqueued += 1
+            self._last_seq[key] = self._enqueued
+            self._queue.put((key, path, body))
+
+    def wait(self, key=None):
+        """Blocks until the writes for ``key`` (or all writes if ``None``) have been sent."""
+
+        with self._cond:
+            seq = self._enqueued if key is None else self._last_seq.get(key, 0)
+            while self._done < seq:
+                self._cond.wait()
+            if key is not None and self._last_seq.get(key) == seq:
+                del self._last_seq[key]
+        self.check()
+
+    def check(self):
+        with self._cond:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        if self._pid != os.getpid():
+            return  # the sender thread doesn't exist in a forked child
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self.check()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._send(*item)
+            except Exception as e:
+                with self._cond:
+                    if self._error is None:
+                        self._error = e
+            with self._cond:
+                self._done += 1
+                self._cond.notify_all()
@@ -5,5 +5,7 @@ setup(
     name="plumtuna",
     version="0.0.1",
     packages=find_packages(),
+    python_requires=">=3.7",
     install_requires=["optuna", "requests"],
+    extras_require={"aio": ["aiohttp"], "numpy": ["numpy"]},
 )
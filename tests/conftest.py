@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'benchmarks'))
+
+from fake_daemon import FakeDaemon  # NOQA
+from plumtuna import PlumtunaStorage  # NOQA
+
+
+@pytest.fixture
+def daemon():
+    d = FakeDaemon()
+    yield d
+    d.close()
+
+
+@pytest.fixture
+def make_storage(daemon):
+    storages = []
+
+    def make(**kwargs):
+        storage = PlumtunaStorage(server=daemon, **kwargs)
+        storages.append(storage)
+        return storage
+
+    yield make
+    for storage in storages:
+        storage.close()
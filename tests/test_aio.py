@@ -0,0 +1,112 @@
+import asyncio
+
+from optuna import distributions
+from optuna import structs
+import pytest
+
+pytest.importorskip('aiohttp')
+
+
+def test_sync_storage_closes_the_server_it_spawned(daemon, monkeypatch):
+    import plumtuna.aio
+
+    closed = []
+
+    class Server(object):
+        def __init__(self, *args):
+            self.http_port = daemon.http_port
+
+        def close(self):
+            closed.append(self)
+
+    monkeypatch.setattr(plumtuna.aio, 'PlumtunaServer', Server)
+    storage = plumtuna.aio.SyncPlumtunaStorage()
+    study_id = storage.create_new_study_id()
+    storage.create_new_trial_id(study_id)
+    assert storage.get_n_trials(study_id) == 1
+    storage.close()
+    assert closed == [storage.storage.server]
+
+    storage = plumtuna.aio.SyncPlumtunaStorage(server=Server())
+    storage.close()
+    assert len(closed) == 1  # not ours to close
+
+
+def test_coroutine_api(daemon):
+    from plumtuna.aio import AsyncPlumtunaStorage
+
+    async def main():
+        storage = AsyncPlumtunaStorage(server=daemon)
+        try:
+            study_id = await storage.create_new_study_id()
+            await storage.set_study_direction(study_id, structs.StudyDirection.MAXIMIZE)
+            await storage.set_study_user_attr(study_id, 'k', [1])
+            trial_ids = await asyncio.gather(
+                *[storage.create_new_trial_id(study_id) for _ in range(10)])
+
+            async def report(i, trial_id):
+                await storage.set_trial_param(trial_id, 'x', i / 10.0,
+                                              distributions.UniformDistribution(0.0, 1.0))
+                await storage.set_trial_intermediate_value(trial_id, 0, float(i))
+                await storage.set_trial_value(trial_id, float(i % 4))
+                await storage.set_trial_state(trial_id, structs.TrialState.COMPLETE)
+
+            await asyncio.gather(*[report(i, t) for i, t in enumerate(trial_ids)])
+
+            # Concurrent reads share polls.
+            polls = []
+            request = storage._request
+
+            async def counting(method, path, body=None):
+                if method == 'GET' and '/subscribe/' in path:
+                    polls.append(path)
+                return await request(method, path, body)
+
+            storage._request = counting
+            results = await asyncio.gather(*[storage.get_all_trials(study_id) for _ in range(20)])
+            assert len(polls) <= 2
+            assert all(len(trials) == 10 for trials in results)
+
+            assert await storage.get_n_trials(study_id, structs.TrialState.COMPLETE) == 10
+            assert (await storage.get_best_trial(study_id)).value == 3.0
+            assert await storage.get_trial_param(trial_ids[5], 'x') == 0.5
+            assert (await storage.get_trial(trial_ids[5])).intermediate_values == {0: 5.0}
+            attrs = await storage.get_study_user_attrs(study_id)
+            attrs['k'].append(2)
+            assert await storage.get_study_user_attrs(study_id) == {'k': [1]}
+        finally:
+            await storage.close()
+
+    asyncio.run(main())
+
+
+def test_subscriber_task_survives_failing_polls(daemon):
+    from plumtuna.aio import AsyncPlumtunaStorage
+
+    async def main():
+        storage = AsyncPlumtunaStorage(server=daemon)
+        try:
+            study_id = await storage.create_new_study_id()
+            failures = []
+            request = storage._request
+
+            async def failing(method, path, body=None):
+                if '/subscribe/' in path and len(failures) < 2:
+                    failures.append(path)
+                    raise RuntimeError('daemon unavailable')
+                return await request(method, path, body)
+
+            storage._request = failing
+            storage.start_subscriber(interval=0.01)
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if len(failures) == 2 and storage._subscriber_error is None:
+                    break
+            assert not storage._subscriber.done()
+            assert len(failures) == 2 and storage._subscriber_error is None
+            await storage.create_new_trial_id(study_id)
+            assert await storage.get_n_trials(study_id) == 1
+        finally:
+            await storage.close()
+
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+import json
+import os
+import threading
+import time
+
+from optuna import structs
+import pytest
+
+from plumtuna import PlumtunaStorage
+
+
+def test_concurrent_reads_share_polls(make_storage):
+    storage = make_storage()
+    study_id = storage.create_new_study_id()
+    for _ in range(3):
+        storage.create_new_trial_id(study_id)
+
+    polls = []
+    request = storage._request
+
+    def slow_request(method, path, body=None):
+        if '/subscribe/' in path:
+            polls.append(path)
+            time.sleep(0.05)
+        return request(method, path, body)
+
+    storage._request = slow_request
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(storage.get_n_trials(study_id)))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [3] * 8
+    assert len(polls) <= 2  # the one in flight, and one shared by everyone who came later
+
+
+def test_async_write_error_propagates_to_the_writer(make_storage):
+    storage = make_storage(async_writes=True)
+    study_id = storage.create_new_study_id()
+    trial_id = storage.create_new_trial_id(study_id)
+    storage.set_trial_value('{}.99'.format(study_id), 1.0)  # no such trial
+    with pytest.raises(AssertionError, match='not found'):
+        storage.set_trial_state(trial_id, structs.TrialState.COMPLETE)
+    assert storage.get_trial(trial_id).state == structs.TrialState.COMPLETE
+
+
+def test_forked_child_resubscribes(daemon):
+    storage = PlumtunaStorage(server=daemon, poll_interval=0.02)
+    try:
+        study_id = storage.create_new_study_id()
+        storage.create_new_trial_id(study_id)
+        assert storage.get_n_trials(study_id) == 1
+        parent_subscribe_id = storage.studies[study_id].subscribe_id
+
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # child
+            try:
+                storage.create_new_trial_id(study_id)
+                result = {'n_trials': storage.get_n_trials(study_id),
+                          'subscribe_id': storage.studies[study_id].subscribe_id}
+                storage.close()
+            except BaseException as e:
+                result = {'error': repr(e)}
+            os.write(w, json.dumps(result).encode('utf-8'))
+            os._exit(0)
+
+        os.close(w)
+        with os.fdopen(r, 'rb') as f:
+            result = json.loads(f.read().decode('utf-8'))
+        os.waitpid(pid, 0)
+        assert result.get('error') is None
+        assert result['n_trials'] == 2
+        assert result['subscribe_id'] != parent_subscribe_id
+
+        # The parent's subscriber picks up the child's trial.
+        deadline = time.time() + 5
+        while storage.get_n_trials(study_id) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert storage.get_n_trials(study_id) == 2
+        assert storage.studies[study_id].subscribe_id == parent_subscribe_id
+    finally:
+        storage.close()
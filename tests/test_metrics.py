@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from plumtuna.metrics import Metrics
+from plumtuna.metrics import endpoint
+
+
+@pytest.mark.parametrize('method, path, expected', [
+    ('POST', '/studies', 'POST /studies'),
+    ('GET', '/study_names/my%20study', 'GET /study_names/{study_name}'),
+    ('POST', '/studies/s1/trials', 'POST /studies/{study_id}/trials'),
+    ('GET', '/studies/s1/subscribe/3', 'GET /studies/{study_id}/subscribe/{subscribe_id}'),
+    ('GET', '/studies/s1/n_trials?state=COMPLETE', 'GET /studies/{study_id}/n_trials'),
+    ('PUT', '/trials/s1.12/params/x', 'PUT /trials/{trial_id}/params/{name}'),
+    ('PUT', '/trials/s1.12/intermediate_values/7',
+     'PUT /trials/{trial_id}/intermediate_values/{step}'),
+    ('PUT', '/trials/s1.12/user_attrs/k', 'PUT /trials/{trial_id}/user_attrs/{key}'),
+    ('PUT', '/trials/s1.12/state', 'PUT /trials/{trial_id}/state'),
+])
+def test_endpoint_replaces_identifiers(method, path, expected):
+    assert endpoint(method, path) == expected
+
+
+def _metrics():
+    metrics = Metrics(buckets=(0.001, 0.01))
+    metrics.observe_request('PUT', '/trials/s1.0/value', 0.0005, 10, 4)
+    metrics.observe_request('PUT', '/trials/s1.1/value', 0.005, 12, 4)
+    metrics.observe_request('PUT', '/trials/s1.2/value', 0.5, 11, 4)
+    metrics.observe_lock_wait('study_poll', 0.002)
+    metrics.observe_poll(5)
+    metrics.observe_replica_lag(0.02)
+    return metrics
+
+
+def test_snapshot_shape():
+    s = _metrics().snapshot()
+    json.dumps(s)
+    assert sorted(s) == ['lock_waits', 'poll_messages', 'replica_lag', 'requests']
+    assert s['requests'] == {
+        'PUT /trials/{trial_id}/value': {
+            'count': 3, 'sum': pytest.approx(0.5055),
+            'buckets': [('0.001', 1), ('0.01', 1), ('+Inf', 1)],
+            'bytes_sent': 33, 'bytes_received': 12,
+        },
+    }
+    assert s['lock_waits'] == {'study_poll': {
+        'count': 1, 'sum': 0.002, 'buckets': [('0.001', 0), ('0.01', 1), ('+Inf', 0)]}}
+    assert s['poll_messages']['count'] == 1 and s['poll_messages']['sum'] == 5
+    assert s['replica_lag']['buckets'] == [('0.001', 0), ('0.01', 0), ('+Inf', 1)]
+
+
+def test_prometheus_buckets_are_cumulative():
+    lines = _metrics().prometheus().splitlines()
+    name = 'plumtuna_request_seconds'
+    labels = 'endpoint="PUT /trials/{trial_id}/value"'
+    assert '# TYPE {} histogram'.format(name) in lines
+    assert '{}_bucket{{{},le="0.001"}} 1'.format(name, labels) in lines
+    assert '{}_bucket{{{},le="0.01"}} 2'.format(name, labels) in lines
+    assert '{}_bucket{{{},le="+Inf"}} 3'.format(name, labels) in lines
+    assert '{}_count{{{}}} 3'.format(name, labels) in lines
+    assert 'plumtuna_bytes_sent_total{{{}}} 33'.format(labels) in lines
+    assert 'plumtuna_poll_messages_bucket{le="1"} 0' in lines
+    assert 'plumtuna_poll_messages_bucket{le="10"} 1' in lines
+    assert 'plumtuna_poll_messages_bucket{le="+Inf"} 1' in lines
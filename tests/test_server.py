@@ -0,0 +1,60 @@
+import os
+import subprocess
+
+import pytest
+
+import plumtuna.server
+
+
+def test_detached_daemon_does_not_inherit_stdout_and_stderr(monkeypatch):
+    spawned = []
+
+    class Popen(object):
+        pid = 12345
+
+        def __init__(self, args, **kwargs):
+            spawned.append(kwargs)
+
+    monkeypatch.setattr(plumtuna.server.subprocess, 'Popen', Popen)
+    monkeypatch.setattr(plumtuna.server.PlumtunaServer, 'wait_until_ready', lambda self, t: None)
+    plumtuna.server.PlumtunaServer(bind_addr='127.0.0.1', detached=True)
+    assert spawned[0]['stdout'] == subprocess.DEVNULL
+    assert spawned[0]['stderr'] == subprocess.DEVNULL
+
+
+def test_private_dir_is_created_for_the_user_only(tmp_path):
+    path = str(tmp_path / 'state')
+    assert plumtuna.server.private_dir(path) == path
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    assert plumtuna.server.private_dir(path) == path  # already there
+
+
+def test_private_dir_refuses_directories_others_control(tmp_path, monkeypatch):
+    writable = tmp_path / 'writable'
+    writable.mkdir()
+    os.chmod(str(writable), 0o777)
+    with pytest.raises(PermissionError):
+        plumtuna.server.private_dir(str(writable))
+
+    target = tmp_path / 'target'
+    target.mkdir(mode=0o700)
+    os.symlink(str(target), str(tmp_path / 'link'))
+    with pytest.raises(PermissionError):
+        plumtuna.server.private_dir(str(tmp_path / 'link'))
+
+    monkeypatch.setattr(plumtuna.server.os, 'getuid', lambda: os.stat(str(target)).st_uid + 1)
+    with pytest.raises(PermissionError):
+        plumtuna.server.private_dir(str(target))
+
+
+def test_state_dir_prefers_the_runtime_dir(tmp_path, monkeypatch):
+    import plumtuna.shared
+
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    expected = os.path.join(str(tmp_path), 'plumtuna-{}'.format(os.getuid()))
+    assert plumtuna.server.default_state_dir() == expected
+    assert plumtuna.shared.default_state_dir() == expected
+
+    monkeypatch.delenv('XDG_RUNTIME_DIR')
+    assert plumtuna.server.default_state_dir('/dev/shm') == \
+        '/dev/shm/plumtuna-{}'.format(os.getuid())
@@ -0,0 +1,138 @@
+import math
+import struct
+import time
+
+from optuna import distributions
+from optuna import structs
+import pytest
+
+_DISTRIBUTION = distributions.UniformDistribution(0.0, 1.0)
+
+
+def _add_trials(storage, study_id, n):
+    for i in range(n):
+        trial_id = storage.create_new_trial_id(study_id)
+        storage.set_trial_param(trial_id, 'x', i / float(n), _DISTRIBUTION)
+        storage.set_trial_intermediate_value(trial_id, 0, float(i))
+        storage.set_trial_value(trial_id, float(i))
+        storage.set_trial_state(trial_id, structs.TrialState.COMPLETE)
+
+
+def test_follower_requests_a_poll_from_the_leader(make_storage):
+    # The leader only polls every 10 seconds unless a follower asks it to.
+    leader = make_storage(shared_replica=True, poll_interval=10)
+    follower = make_storage(shared_replica=True, poll_interval=10)
+    study_id = leader.create_new_study_id()
+    follower.get_study_id_from_name(leader.get_study_name_from_id(study_id))
+    assert leader._replicas[study_id].is_leader
+    assert not follower._replicas[study_id].is_leader
+
+    start = time.time()
+    _add_trials(follower, study_id, 3)
+    assert [t.value for t in follower.get_all_trials(study_id)] == [0.0, 1.0, 2.0]
+    assert time.time() - start < 5
+
+
+def test_leader_publishes_changed_trials_only(make_storage):
+    leader = make_storage(shared_replica=True, poll_interval=10)
+    follower = make_storage(shared_replica=True, poll_interval=10)
+    study_id = leader.create_new_study_id()
+    _add_trials(leader, study_id, 5)
+    follower.get_study_id_from_name(leader.get_study_name_from_id(study_id))
+    before = follower.get_all_trials(study_id)
+    records = dict(follower.studies[study_id].trials)
+    generation = leader._replicas[study_id]._state()[2]
+
+    trial_id = before[2].trial_id
+    leader.set_trial_user_attr(trial_id, 'k', 1)
+    _add_trials(leader, study_id, 1)
+    leader.get_all_trials(study_id)  # polls and publishes
+    after = follower.get_all_trials(study_id)
+
+    assert leader._replicas[study_id]._state()[2] == generation  # appended to the log
+    assert len(after) == 6 and after[2].user_attrs == {'k': 1}
+    assert follower.get_best_trial(study_id).value == 0.0
+    study = follower.studies[study_id]
+    assert study.trials[before[0].trial_id] is records[before[0].trial_id]
+    assert study.trials[trial_id] is not records[trial_id]
+    assert list(study.step_values(0, structs.TrialState.COMPLETE)) == [0.0, 0.0, 1.0, 2.0, 3.0,
+                                                                         4.0]
+
+
+def test_follower_takes_over_from_a_closed_leader(make_storage):
+    leader = make_storage(shared_replica=True, poll_interval=10)
+    follower = make_storage(shared_replica=True, poll_interval=10)
+    study_id = leader.create_new_study_id()
+    _add_trials(leader, study_id, 3)
+    follower.get_study_id_from_name(leader.get_study_name_from_id(study_id))
+    assert follower.get_n_trials(study_id) == 3
+
+    leader.close()
+    _add_trials(follower, study_id, 2)
+    assert follower.get_n_trials(study_id) == 5
+    assert follower._replicas[study_id].is_leader
+    assert [t.value for t in follower.get_all_trials(study_id)] == [0.0, 1.0, 2.0, 0.0, 1.0]
+
+
+def test_follower_sees_nan_like_the_leader(make_storage):
+    leader = make_storage(shared_replica=True, poll_interval=10)
+    follower = make_storage(shared_replica=True, poll_interval=10)
+    study_id = leader.create_new_study_id()
+    trial_id = leader.create_new_trial_id(study_id)
+    leader.set_trial_intermediate_value(trial_id, 0, float('nan'))
+    leader.set_trial_value(trial_id, float('nan'))
+    leader.set_trial_state(trial_id, structs.TrialState.COMPLETE)
+    leader.get_all_trials(study_id)
+    follower.get_study_id_from_name(leader.get_study_name_from_id(study_id))
+
+    trial = follower.get_trial(trial_id)
+    assert math.isnan(trial.value) and math.isnan(trial.intermediate_values[0])
+    values = follower.get_intermediate_values_at_step(study_id, 0)
+    assert len(values) == 1 and math.isnan(values[0])
+
+
+def test_follower_requests_polls_only_when_behind(make_storage, monkeypatch):
+    leader = make_storage(shared_replica=True, poll_interval=10)
+    follower = make_storage(shared_replica=True, poll_interval=10)
+    study_id = leader.create_new_study_id()
+    _add_trials(leader, study_id, 2)
+    follower.get_study_id_from_name(leader.get_study_name_from_id(study_id))
+    assert follower.get_n_trials(study_id) == 2  # the first sync waits for a fresh poll
+    replica = follower._replicas[study_id]
+    requests = []
+    request = replica.request
+    monkeypatch.setattr(replica, 'request', lambda: requests.append(1) or request())
+
+    for _ in range(5):
+        assert follower.get_n_trials(study_id) == 2
+    assert requests == []
+    _add_trials(follower, study_id, 1)
+    assert follower.get_n_trials(study_id) == 3
+    assert len(requests) == 1
+
+
+def test_successor_recovers_from_a_leader_that_died_mid_update(make_storage, monkeypatch):
+    import plumtuna.shared
+
+    monkeypatch.setattr(plumtuna.shared, '_MAX_UPDATE_WAIT', 0.05)
+    leader = make_storage(shared_replica=True, poll_interval=10)
+    follower = make_storage(shared_replica=True, poll_interval=10)
+    study_id = leader.create_new_study_id()
+    _add_trials(leader, study_id, 3)
+    follower.get_study_id_from_name(leader.get_study_name_from_id(study_id))
+
+    # The leader dies between the two version bumps of an update.
+    control = leader._replicas[study_id]._control
+    version, = struct.unpack_from('<Q', control)
+    struct.pack_into('<Q', control, 0, version + 1)
+    with pytest.raises(TimeoutError):
+        follower._replicas[study_id].state()
+    leader.close()
+
+    _add_trials(follower, study_id, 1)
+    assert follower.get_n_trials(study_id) == 4
+    assert follower._replicas[study_id].is_leader
+    assert [t.value for t in follower.get_all_trials(study_id)] == [0.0, 1.0, 2.0, 0.0]
+    other = make_storage(shared_replica=True, poll_interval=10)
+    other.get_study_id_from_name(leader.get_study_name_from_id(study_id))
+    assert other.get_n_trials(study_id) == 4
@@ -0,0 +1,75 @@
+import math
+
+from optuna import structs
+
+from fake_daemon import FakeDaemon
+from plumtuna import PlumtunaStorage
+
+
+def _values(storage, study_id):
+    return [t.value for t in storage.get_all_trials(study_id)]
+
+
+def test_snapshot_is_resumed(daemon, make_storage, tmp_path):
+    storage = make_storage(snapshot_dir=str(tmp_path), snapshot_interval=1)
+    study_id = storage.create_new_study_id('x')
+    daemon.populate(study_id, 5, n_params=1, n_steps=1)
+    assert len(_values(storage, study_id)) == 5
+    storage.close()
+
+    daemon.populate(study_id, 1, n_params=1, n_steps=1)
+    storage = make_storage(snapshot_dir=str(tmp_path))
+    storage.get_study_id_from_name('x')
+    assert storage.studies[study_id].skip == 5 * 5  # loaded from the snapshot
+    assert len(_values(storage, study_id)) == 6
+    assert storage.studies[study_id].skip == 0
+
+
+def test_snapshot_of_another_history_is_dropped(make_storage, tmp_path):
+    storage = make_storage(snapshot_dir=str(tmp_path), snapshot_interval=1)
+    study_id = storage.create_new_study_id('x')
+    for _ in range(3):
+        storage.set_trial_value(storage.create_new_trial_id(study_id), 1.0)
+    assert _values(storage, study_id) == [1.0] * 3
+    storage.close()
+
+    # Another daemon (e.g. after a restart) with a study of the same name and id.
+    other = FakeDaemon()
+    try:
+        assert other.create_study('x') == study_id
+        for _ in range(4):
+            other.put_trial(other.create_trial(study_id), ['value'], 2.0)
+        storage = PlumtunaStorage(server=other, snapshot_dir=str(tmp_path))
+        try:
+            storage.get_study_id_from_name('x')
+            assert storage.studies[study_id].skip == 6  # loaded from the snapshot
+            assert _values(storage, study_id) == [2.0] * 4
+        finally:
+            storage.close()
+    finally:
+        other.close()
+
+
+def test_snapshot_keeps_nan_apart_from_unset(make_storage, tmp_path):
+    nan = float('nan')
+    storage = make_storage(snapshot_dir=str(tmp_path), snapshot_interval=1)
+    study_id = storage.create_new_study_id('x')
+    trial_ids = [storage.create_new_trial_id(study_id) for _ in range(3)]
+    storage.set_trial_intermediate_value(trial_ids[0], 0, nan)
+    storage.set_trial_intermediate_value(trial_ids[1], 0, 1.0)
+    storage.set_trial_value(trial_ids[0], nan)
+    storage.set_trial_value(trial_ids[1], 1.0)
+    for trial_id in trial_ids[:2]:
+        storage.set_trial_state(trial_id, structs.TrialState.COMPLETE)
+    storage.get_all_trials(study_id)
+    storage.close()
+
+    storage = make_storage(snapshot_dir=str(tmp_path))
+    storage.get_study_id_from_name('x')
+    assert storage.studies[study_id].skip > 0  # loaded from the snapshot
+    trials = storage.get_all_trials(study_id)
+    assert math.isnan(trials[0].value) and math.isnan(trials[0].intermediate_values[0])
+    assert trials[1].value == 1.0 and trials[1].intermediate_values == {0: 1.0}
+    assert trials[2].value is None and trials[2].intermediate_values == {}
+    values = storage.get_intermediate_values_at_step(study_id, 0, structs.TrialState.COMPLETE)
+    assert values[0] == 1.0 and math.isnan(values[1])
@@ -0,0 +1,245 @@
+import io
+import math
+
+from optuna import distributions
+from optuna import structs
+import pytest
+
+
+@pytest.mark.parametrize('order', [
+    (distributions.UniformDistribution(0.0, 10.0), distributions.IntUniformDistribution(0, 10)),
+    (distributions.IntUniformDistribution(0, 10), distributions.UniformDistribution(0.0, 10.0)),
+    (distributions.LogUniformDistribution(1.0, 10.0), distributions.UniformDistribution(1.0, 10.0)),
+    (distributions.UniformDistribution(0, 1), distributions.UniformDistribution(0.0, 1.0)),
+    (distributions.CategoricalDistribution((1, 0)),
+     distributions.CategoricalDistribution((True, False))),
+    (distributions.CategoricalDistribution((1, 2)),
+     distributions.CategoricalDistribution((1.0, 2.0))),
+])
+def test_set_trial_param_keeps_distribution_type(daemon, make_storage, order):
+    # Each pair compares (and hashes) equal but serializes differently.
+    storage = make_storage()
+    study_id = storage.create_new_study_id()
+    trial_id = storage.create_new_trial_id(study_id)
+    for i, distribution in enumerate(order):
+        storage.set_trial_param(trial_id, 'p{}'.format(i), 1.0, distribution)
+
+    params = daemon.studies[study_id].trials[trial_id]['params']
+    trial = storage.get_trial(trial_id)
+    for i, distribution in enumerate(order):
+        name = 'p{}'.format(i)
+        assert params[name]['distribution'] == distributions.distribution_to_json(distribution)
+        expected = distribution.to_external_repr(1.0)
+        assert trial.params[name] == expected and type(trial.params[name]) is type(expected)
+
+
+def test_request_bodies_accept_what_json_does(make_storage):
+    import numpy
+
+    storage = make_storage()
+    study_id = storage.create_new_study_id()
+    trial_id = storage.create_new_trial_id(study_id)
+    storage.set_trial_intermediate_value(trial_id, 0, numpy.float64(0.5))
+    storage.set_trial_intermediate_value(trial_id, 1, float('nan'))
+    storage.set_trial_user_attr(trial_id, 'by_step', {1: 'a'})
+    storage.set_trial_value(trial_id, numpy.float64(1.5))
+
+    other = make_storage()
+    other.get_study_id_from_name(storage.get_study_name_from_id(study_id))
+    trial = other.get_trial(trial_id)
+    assert trial.intermediate_values[0] == 0.5
+    assert math.isnan(trial.intermediate_values[1])
+    assert trial.user_attrs['by_step'] == {'1': 'a'}
+    assert trial.value == 1.5
+
+
+def test_get_all_trials_returns_a_new_list(make_storage):
+    storage = make_storage()
+    study_id = storage.create_new_study_id()
+    trial_ids = [storage.create_new_trial_id(study_id) for _ in range(3)]
+
+    storage.get_all_trials(study_id).reverse()
+    storage.set_trial_user_attr(trial_ids[0], 'k', 1)
+    assert [t.trial_id for t in storage.get_all_trials(study_id)] == trial_ids
+
+
+def _same(a, b):
+    return a == b or (math.isnan(a) and math.isnan(b))
+
+
+def test_median_pruner_hooks_match_optuna(make_storage):
+    from optuna.storages.base import BaseStorage
+
+    storage = make_storage()
+    study_id = storage.create_new_study_id()
+    trial_ids = [storage.create_new_trial_id(study_id) for _ in range(5)]
+    with pytest.raises(ValueError):
+        storage.get_median_intermediate_result_over_trials(study_id, 0)
+    with pytest.raises(ValueError):
+        storage.get_best_intermediate_result_over_steps(trial_ids[0])
+
+    nan = float('nan')
+    reports = [[3.0, nan], [nan, nan], [1.0, 2.0], [nan, 5.0], [0.5, nan]]
+    for trial_id, values in zip(trial_ids, reports):
+        for step, value in enumerate(values):
+            storage.set_trial_intermediate_value(trial_id, step, value)
+    storage.set_trial_intermediate_value(trial_ids[3], 0, 4.0)  # replaces a NaN
+    for trial_id in trial_ids[:4]:  # the last one stays RUNNING
+        storage.set_trial_state(trial_id, structs.TrialState.COMPLETE)
+
+    for trial_id in trial_ids:
+        assert _same(storage.get_best_intermediate_result_over_steps(trial_id),
+                     BaseStorage.get_best_intermediate_result_over_steps(storage, trial_id))
+    for step in range(3):
+        assert _same(storage.get_median_intermediate_result_over_trials(study_id, step),
+                     BaseStorage.get_median_intermediate_result_over_trials(storage, study_id,
+                                                                           step))
+    values = storage.get_intermediate_values_at_step(study_id, 0, structs.TrialState.COMPLETE)
+    assert list(values[:3]) == [1.0, 3.0, 4.0] and math.isnan(values[3])
+
+
+@pytest.mark.parametrize('direction', [structs.StudyDirection.MINIMIZE,
+                                       structs.StudyDirection.MAXIMIZE])
+def test_best_trial_breaks_ties_like_optuna(make_storage, direction):
+    storage = make_storage()
+    study_id = storage.create_new_study_id()
+    storage.set_study_direction(study_id, direction)
+    # Both the best and the worst value are tied between trials whose ids sort the other way
+    # round as strings (e.g. s1.2 and s1.10).
+    values = [5.0, 3.0, 1.0, 3.0, 9.0, 5.0, 2.0, 9.0, 4.0, 4.0, 1.0, 9.0]
+    for value in values:
+        trial_id = storage.create_new_trial_id(study_id)
+        storage.set_trial_value(trial_id, value)
+        storage.set_trial_state(trial_id, structs.TrialState.COMPLETE)
+
+    # As in `BaseStorage.get_best_trial`, which only minimizes in this version of optuna.
+    pick = max if direction == structs.StudyDirection.MAXIMIZE else min
+    expected = pick(storage.get_all_trials(study_id), key=lambda t: t.value)
+    assert storage.get_best_trial(study_id).trial_id == expected.trial_id
+
+
+@pytest.mark.parametrize('max_trial_details, bulk', [(18, False), (2, True)])
+def test_get_all_trials_fetches_evicted_detail(make_storage, max_trial_details, bulk):
+    storage = make_storage(max_trial_details=max_trial_details)
+    study_id = storage.create_new_study_id()
+    for i in range(20):
+        trial_id = storage.create_new_trial_id(study_id)
+        storage.set_trial_intermediate_value(trial_id, 0, float(i))
+        storage.set_trial_user_attr(trial_id, 'i', i)
+        storage.set_trial_state(trial_id, structs.TrialState.COMPLETE)
+    n_evicted = 20 - max_trial_details
+
+    paths = []
+    get = storage._get
+    storage._get = lambda path: paths.append(path) or get(path)
+    trials = storage.get_all_trials(study_id)
+    assert [t.user_attrs['i'] for t in trials] == list(range(20))
+    assert [t.intermediate_values[0] for t in trials] == [float(i) for i in range(20)]
+    assert storage.studies[study_id].n_evicted() == n_evicted
+    assert len(paths) == (1 if bulk else n_evicted)
+
+
+def test_trial_table_is_kept_current(make_storage):
+    numpy = pytest.importorskip('numpy')
+
+    storage = make_storage()
+    study_id = storage.create_new_study_id()
+    first = storage.create_new_trial_id(study_id)
+    storage.set_trial_param(first, 'x', 0.5, distributions.UniformDistribution(0.0, 1.0))
+    storage.set_trial_intermediate_value(first, 0, 1.0)
+    table = storage.get_trial_table(study_id)
+    assert table.param_names == ['x'] and list(table.steps) == [0]
+    kept = storage.studies[study_id]._table
+
+    # A trial with a new step and a new param, and a change of state after the table is built.
+    second = storage.create_new_trial_id(study_id)
+    storage.set_trial_param(second, 'y', 2.0, distributions.UniformDistribution(0.0, 4.0))
+    storage.set_trial_intermediate_value(second, 3, 7.0)
+    storage.set_trial_value(first, 0.25)
+    storage.set_trial_state(first, structs.TrialState.COMPLETE)
+
+    table = storage.get_trial_table(study_id)
+    assert storage.studies[study_id]._table is kept  # updated in place, not rebuilt
+    assert table.trial_ids == [first, second]
+    assert list(table.states) == [structs.TrialState.COMPLETE.value,
+                                  structs.TrialState.RUNNING.value]
+    assert table.values[0] == 0.25 and math.isnan(table.values[1])
+    assert table.param_names == ['x', 'y']
+    numpy.testing.assert_array_equal(table.params, [[0.5, numpy.nan], [numpy.nan, 2.0]])
+    assert list(table.steps) == [0, 3]
+    numpy.testing.assert_array_equal(table.intermediate_values,
+                                     [[1.0, numpy.nan], [numpy.nan, 7.0]])
+
+    # The same as a table built from scratch.
+    other = make_storage()
+    other.get_study_id_from_name(storage.get_study_name_from_id(study_id))
+    rebuilt = other.get_trial_table(study_id)
+    for a, b in zip(table, rebuilt):
+        numpy.testing.assert_array_equal(a, b)
+
+
+def _fields(trial):
+    return (trial.state, trial.value, trial.params, trial.params_in_internal_repr,
+            trial.intermediate_values, trial.user_attrs, trial.system_attrs)
+
+
+def test_dump_and_load_round_trip(make_storage):
+    storage = make_storage()
+    study_id = storage.create_new_study_id()
+    storage.set_study_direction(study_id, structs.StudyDirection.MAXIMIZE)
+    storage.set_study_user_attr(study_id, 'k', [1, 2])
+    states = [structs.TrialState.COMPLETE, structs.TrialState.PRUNED, structs.TrialState.RUNNING]
+    for i in range(12):
+        trial_id = storage.create_new_trial_id(study_id)
+        storage.set_trial_param(trial_id, 'x', i / 12.0, distributions.UniformDistribution(0, 1))
+        if i % 2:
+            storage.set_trial_param(trial_id, 'c', 1.0,
+                                    distributions.CategoricalDistribution(('a', 'b')))
+        for step in range(i % 4):
+            storage.set_trial_intermediate_value(trial_id, step, float(i * step))
+        storage.set_trial_user_attr(trial_id, 'i', i)
+        storage.set_trial_system_attr(trial_id, 'tag', {'i': [i]})
+        if i % 3 != 2:
+            storage.set_trial_value(trial_id, float(12 - i))
+        storage.set_trial_state(trial_id, states[i % 3])
+
+    # Several batches, whose trials are filled in concurrently.
+    other = make_storage()
+    copy_id = other.create_new_study_id()
+    copy_ids = other.import_trials(copy_id, storage.export_trials(study_id, batch_size=5),
+                                   batch_size=5, n_workers=4)
+    trials = storage.get_all_trials(study_id)
+    copies = other.get_all_trials(copy_id)
+    assert [t.trial_id for t in copies] == copy_ids
+    assert [_fields(t) for t in copies] == [_fields(t) for t in trials]
+
+    f = io.BytesIO()
+    storage.dump_study(study_id, f)
+    f.seek(0)
+    loaded_id = other.load_study(f, study_name='loaded')
+    assert other.get_study_name_from_id(loaded_id) == 'loaded'
+    assert other.get_study_direction(loaded_id) == structs.StudyDirection.MAXIMIZE
+    assert other.get_study_user_attrs(loaded_id) == {'k': [1, 2]}
+    assert [_fields(t) for t in other.get_all_trials(loaded_id)] == [_fields(t) for t in trials]
+
+
+def test_forked_child_does_not_reuse_the_bind_port(daemon, monkeypatch):
+    import plumtuna.storage
+
+    spawned = []
+
+    class Server(object):
+        def __init__(self, bind_addr, bind_port, contact_host, contact_port, ready_timeout):
+            spawned.append((bind_port, contact_host, contact_port))
+            self.http_port, self.pid = daemon.http_port, daemon.pid
+            self.rpc_addr, self.rpc_port = '127.0.0.1', 7000 + len(spawned)
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(plumtuna.storage, 'PlumtunaServer', Server)
+    storage = plumtuna.storage.PlumtunaStorage(bind_port=7364)
+    storage._pid = -1  # as seen from a forked child
+    storage._connect()
+    storage.close()
+    assert spawned == [(7364, None, None), (None, '127.0.0.1', 7001)]
@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+
+def test_async_write_error_reaches_the_caller_not_the_subscriber(make_storage):
+    storage = make_storage(async_writes=True, poll_interval=0.02)
+    study_id = storage.create_new_study_id()
+    storage.create_new_trial_id(study_id)
+
+    storage.set_trial_user_attr('{}.99'.format(study_id), 'k', 1)  # no such trial
+    time.sleep(0.2)  # several subscriber rounds
+    assert storage._subscriber.is_alive() and storage._subscriber.error is None
+
+    with pytest.raises(AssertionError):
+        storage.get_all_trials(study_id)
+    assert len(storage.get_all_trials(study_id)) == 1
+
+
+def test_subscriber_survives_failing_polls():
+    from plumtuna.subscriber import Subscriber
+
+    calls = []
+
+    def poll(study_id):
+        calls.append(study_id)
+        if len(calls) <= 2:
+            raise RuntimeError('daemon unavailable')
+
+    subscriber = Subscriber(poll, lambda: ['s1'], 0.01)
+    try:
+        deadline = time.time() + 5
+        while len(calls) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        assert subscriber.is_alive()
+        assert subscriber.error is None
+    finally:
+        subscriber.close()
+
+
+def test_trial_created_by_another_worker_is_polled_for(make_storage):
+    from optuna import distributions
+
+    writer = make_storage()
+    reader = make_storage(poll_interval=10)  # the subscriber won't poll again during the test
+    study_id = writer.create_new_study_id()
+    reader.get_study_id_from_name(writer.get_study_name_from_id(study_id))
+    reader.get_all_trials(study_id)
+
+    trial_id = writer.create_new_trial_id(study_id)
+    writer.set_trial_param(trial_id, 'x', 0.5, distributions.UniformDistribution(0.0, 1.0))
+    assert reader.get_trial_param(trial_id, 'x') == 0.5
+    assert reader.get_trial(trial_id).params == {'x': 0.5}
@@ -0,0 +1,66 @@
+import math
+
+from optuna import distributions
+from optuna import structs
+import pytest
+
+from plumtuna.transport import HttpTransport
+
+msgpack = pytest.importorskip('msgpack')
+
+_DISTRIBUTION = distributions.UniformDistribution(0.0, 1.0)
+
+
+@pytest.fixture
+def unpacked(monkeypatch):
+    """Records the MessagePack payloads decoded by the clients."""
+
+    calls = []
+    unpackb = msgpack.unpackb
+
+    def counting(data, **kwargs):
+        calls.append(len(data))
+        return unpackb(data, **kwargs)
+
+    monkeypatch.setattr(msgpack, 'unpackb', counting)
+    return calls
+
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_replica_decodes_the_negotiated_format(daemon, make_storage, unpacked, binary):
+    daemon.binary = binary
+    storage = make_storage()
+    study_id = storage.create_new_study_id()
+    trial_ids = []
+    for i in range(3):
+        trial_id = storage.create_new_trial_id(study_id)
+        storage.set_trial_param(trial_id, 'x', i / 3.0, _DISTRIBUTION)
+        storage.set_trial_intermediate_value(trial_id, 0, float('nan') if i == 1 else float(i))
+        storage.set_trial_user_attr(trial_id, 'by_step', {1: 'a'})
+        storage.set_trial_value(trial_id, float(i))
+        storage.set_trial_state(trial_id, structs.TrialState.COMPLETE)
+        trial_ids.append(trial_id)
+
+    other = make_storage()
+    other.get_study_id_from_name(storage.get_study_name_from_id(study_id))
+    trials = other.get_all_trials(study_id)
+    assert [t.params['x'] for t in trials] == [0.0, 1 / 3.0, 2 / 3.0]
+    assert math.isnan(trials[1].intermediate_values[0])
+    assert trials[2].intermediate_values[0] == 2.0
+    assert trials[0].user_attrs == {'by_step': {'1': 'a'}}
+    assert bool(unpacked) == binary
+
+    # The records of the replica share one copy of the distribution.
+    records = other.studies[study_id].trials
+    assert records[trial_ids[0]].param_distributions['x'] is \
+        records[trial_ids[2]].param_distributions['x']
+
+
+def test_transport_without_binary_asks_for_json(daemon, unpacked):
+    transport = HttpTransport('127.0.0.1', daemon.http_port, binary=False)
+    try:
+        status, res = transport.request('POST', '/studies', {'study_name': 'json'})
+        assert status == 200 and res == {'study_id': daemon.study_names['json']}
+    finally:
+        transport.close()
+    assert unpacked == []
@@ -0,0 +1,50 @@
+import time
+
+import pytest
+
+from plumtuna.writer import WriteBuffer
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_write_buffer_flushes_after_batch_delay_without_further_writes():
+    sent = []
+    buffer = WriteBuffer(lambda *write: sent.append(write), batch_size=100, batch_delay=0.05)
+    buffer.put('s1', 's1.0', '/trials/s1.0/value', 1.0)
+    buffer.put('s1', 's1.0', '/trials/s1.0/state', 'COMPLETE')
+    assert sent == []
+    assert _wait_for(lambda: len(sent) == 2)
+    assert sent == [('s1.0', '/trials/s1.0/value', 1.0), ('s1.0', '/trials/s1.0/state', 'COMPLETE')]
+
+
+def test_write_buffer_reraises_errors_of_timed_flushes():
+    def send(trial_id, path, body):
+        raise RuntimeError('daemon unavailable')
+
+    buffer = WriteBuffer(send, batch_size=100, batch_delay=0.01)
+    buffer.put('s1', 's1.0', '/trials/s1.0/value', 1.0)
+    assert _wait_for(lambda: buffer._error is not None)
+    with pytest.raises(RuntimeError):
+        buffer.put('s1', 's1.0', '/trials/s1.0/value', 2.0)
+
+
+def test_write_buffer_sends_state_changes_after_the_other_writes():
+    sent = []
+
+    def send(trial_id, path, body):
+        time.sleep(0.01 if path.endswith('/value') else 0)
+        sent.append(path)
+
+    buffer = WriteBuffer(send, batch_size=100, batch_delay=10, n_workers=4)
+    buffer.put('s1', 's1.0', '/trials/s1.0/value', 1.0)
+    buffer.put('s1', 's1.0', '/trials/s1.0/params/x', {'value': 0.5})
+    buffer.put('s1', 's1.0', '/trials/s1.0/state', 'COMPLETE')
+    buffer.put('s1', 's1.0', '/trials/s1.0/value', 2.0)
+    buffer.close()
+    assert sorted(sent[:2]) == ['/trials/s1.0/params/x', '/trials/s1.0/value']
+    assert sent[2:] == ['/trials/s1.0/state']